@@ -1,875 +1,3197 @@
-﻿# ai_response.py
-import httpx
-import os
-import re
-import subprocess
-from io import BytesIO
-import uuid
-import logging
-from datetime import datetime
-from fastapi import HTTPException
-from openai import AsyncOpenAI, OpenAI
-from typing import Optional, Dict, Any
-from bson import ObjectId
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
-from database import (
-    ai_configs_collection, whatsapp_configs_collection, processed_messages_collection,
-    messages_collection, customers_collection, products_collection, prompts_collection,
-    conversation_threads_collection
-)
-from auth import get_user_token
-import asyncio
-import json
-import hashlib
-import tempfile
-
-from sentence_transformers import SentenceTransformer, util
-import random
-import numpy as np
-import torch
-
-
-
-# تنظیم لاگینگ
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('ai_response.log'),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger(__name__)
-
-##################################################################################
-
-model = SentenceTransformer("intfloat/multilingual-e5-large")
-
-def prepare(text): return "query: " + text.strip()
-
-buy_intents = [
-    "query: buy", "query: order", "query: purchase", "query: i want to buy",
-    "query: how to buy", "query: can i order", "query: where to buy"
-]
-buy_embeddings = model.encode(buy_intents, convert_to_tensor=True)
-
-def has_buy_intent(user_input: str, threshold: float = 0.8) -> bool:
-    user_embedding = model.encode(prepare(user_input), convert_to_tensor=True)
-    score = util.pytorch_cos_sim(user_embedding, buy_embeddings)[0].max().item()
-    return score >= threshold
-
-
-
-
-def get_user_products_with_urls(user_id: str) -> list[dict]:
-    """
-    گرفتن محصولات دارای name و buyurl (داخل attributes) برای یک کاربر
-    """
-    products = products_collection.find({
-        "user_id": ObjectId(user_id),
-        "isAvailable": True,
-        "attributes.buyurl": {"$exists": True, "$ne": ""}
-    })
-
-    result = []
-    for p in products:
-        name = p.get("name")
-        buyurl = p.get("attributes", {}).get("buyurl", "").strip()
-        imgurl = p.get("images", [])
-        imgurl=random.choice(imgurl) if imgurl else None        
-        if name and buyurl:
-            result.append({"name": name, "buyurl": buyurl, "imgurl": imgurl})
-    return result
-
-
-def normalize(text: str) -> str:
-    return re.sub(r"[^\w\s]", "", text.lower().strip())
-
-def match_best_products(user_text: str, products: list[str], top_k: int = 1, threshold: float = 0.6, strict: bool = True) -> list[str]:
-    """
-    تطبیق هوشمند + سخت‌گیرانه برای پیدا کردن محصول
-    """
-    query_text = f"query: {user_text.strip()}"
-    passages = [f"passage: {name.strip()}" for name in products]
-
-    query_embedding = model.encode(query_text, convert_to_tensor=True)
-    product_embeddings = model.encode(passages, convert_to_tensor=True)
-
-    similarities = util.cos_sim(query_embedding, product_embeddings)[0]
-
-    top_results = similarities.topk(k=top_k)
-    top_indices = top_results.indices.tolist()
-    top_scores = top_results.values.tolist()
-
-    
-
-    result = []
-    for i, score in zip(top_indices, top_scores):
-        if score >= threshold:
-            product_name = products[i]
-            print('\n\n\n',product_name)
-            # اگر strict باشه بررسی کنیم که آیا بخشی از نام محصول در متن هست یا نه
-            if strict:
-                norm_user = normalize(user_text)
-                norm_prod = normalize(product_name)
-                if any(w in norm_user for w in norm_prod.split()):
-                    result.append(product_name)
-            else:
-                result.append(product_name)
-
-    return result
-
-
-
-async def check_purchase_and_generate_response(message_text: str, user_id: str) -> str | None:
-    """
-    بررسی نیت خرید و پاسخ‌دهی مناسب در صورت تشخیص intent و محصول
-    """
-    matched_intents = has_buy_intent(message_text)
-    print('\n\n\n',matched_intents)
-    if not matched_intents:
-        return None  # نیت خرید تشخیص داده نشد
-
-    # گرفتن لیست محصولات
-    user_id = str(user_id).strip()
-    products = get_user_products_with_urls(user_id)
-    print('\n\n\n',products)
-    if not products:
-        return None
-
-    product_names = [p["name"] for p in products]
-    matched_product_names = match_best_products(message_text, product_names, top_k=1)
-    print('\n\n\n',matched_product_names)
-
-    if matched_product_names:
-        # محصول پیدا شد، برگشت لینک خرید + "Order temp"
-        for p in products:
-            if p["name"] in matched_product_names:
-                return f"{p['buyurl']} {p['imgurl']}  Order temp"
-
-    # نیت خرید هست ولی اسم محصول نبود → پیشنهاد با مثال رندوم
-    random_product = random.choice(product_names)
-    return (
-        f"يرجى كتابة طلب الشراء بهذا الشكل:\n"
-        f"أرغب في شراء {random_product}\n\n"
-        f"Please write your purchase request like this:\n"
-        f"I want to buy {random_product}"
-    )
-
-################################################################################
-
-def check_ai_config():
-    """
-    چک کردن تنظیمات AI فعال و برگرداندن تنظیمات
-    """
-    return ai_configs_collection.find_one({"auto_response_enabled": True})
-
-def sanitize_input(text: str) -> str:
-    """
-    حذف هر چیزی که شبیه کد پایتون یا دستور خطرناک باشد
-    """
-    dangerous_patterns = r'\b(import|eval|exec|os\.|subprocess\.|__import__)\b'
-    if re.search(dangerous_patterns, text, re.IGNORECASE):
-        logger.warning(f"Detected dangerous input: {text}")
-        return "Invalid input detected"
-    sanitized = re.sub(r'[^\w\s,.?!-]', '', text)
-    return sanitized.strip()
-
-
-
-async def upload_json_file(client: OpenAI, product_data: list, user_id: str) -> str:
-    """
-    آپلود فایل JSON محصولات به OpenAI و بازگشت file_id
-    """
-    try:
-        # ایجاد فایل موقت برای JSON
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False, encoding='utf-8') as temp_file:
-            json.dump(product_data, temp_file, ensure_ascii=False, indent=2)
-            temp_file_path = temp_file.name
-
-        # آپلود فایل به OpenAI
-        with open(temp_file_path, 'rb') as file:
-            file_response = client.files.create(
-                file=file,
-                purpose="assistants"
-            )
-        os.unlink(temp_file_path)  # حذف فایل موقت
-        logger.info(f"Uploaded JSON file for user_id={user_id}, file_id={file_response.id}")
-        return file_response.id
-    except Exception as e:
-        logger.error(f"Error uploading JSON file for user_id={user_id}: {str(e)}")
-        raise
-
-async def create_assistant(client: OpenAI, user_id: str, file_id: str, key_points: list, guidelines: list, warnings: list) -> tuple[str, str]:
-    system_prompt = f"""
-You are an assistant working with a JSON dataset stored in a file.
-Follow these prompts to guide your responses:
-
-Key Points:
-{chr(10).join(f"- {kp}" for kp in key_points) if key_points else "None"}
-
-Guidelines:
-{chr(10).join(f"- {gl}" for gl in guidelines) if guidelines else "None"}
-
-Warnings:
-{chr(10).join(f"- {wr}" for wr in warnings) if warnings else "None"}
-
-Important!:Only use the information in the attached file. Do not use any outside knowledge or general world facts. Do not search the web.
-Important!:Keep answers brief, but make sure they still fully address the question.
-Important!:Answer in the same language as the question, using natural conversational writing.
-"""
-    try:
-        # ایجاد Vector Store و اتصال فایل
-        vector_store = client.vector_stores.create(name=f"PropertiesVectorStore_{user_id}")
-        client.vector_stores.file_batches.create(
-            vector_store_id=vector_store.id,
-            file_ids=[file_id]
-        )
-
-        # ایجاد Assistant با اتصال به Vector Store
-        async_client = AsyncOpenAI(api_key=client.api_key)
-        assistant = await async_client.beta.assistants.create(  # همچنان از beta برای assistants استفاده می‌شود
-            name="RealEstateAssistant",
-            instructions=system_prompt,
-            model="gpt-4o-mini",
-            tools=[{"type": "file_search"}],
-            tool_resources={"file_search": {"vector_store_ids": [vector_store.id]}}
-        )
-        logger.info(f"Created new Assistant with ID: {assistant.id} for user_id={user_id}")
-        return assistant.id, vector_store.id
-    except Exception as e:
-        logger.error(f"Error creating Assistant for user_id={user_id}: {str(e)}")
-        raise
-
-async def cancel_all_active_runs_for_user(client: AsyncOpenAI, user_id: str):
-    """
-    لغو تمام runهای فعال برای تردهای مرتبط با کاربر.
-    """
-    try:
-        user_threads = conversation_threads_collection.find({"user_id": ObjectId(user_id)})
-        for thread_entry in user_threads:
-            thread_id = thread_entry.get("thread_id")
-            if not thread_id:
-                continue
-
-            runs = await client.beta.threads.runs.list(thread_id=thread_id)
-            for run in runs.data:
-                if run.status in ("queued", "in_progress", "cancelling"):
-                    try:
-                        await client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
-                        logger.info(f"Cancelled run {run.id} for thread {thread_id}")
-                        await asyncio.sleep(1)
-                    except Exception as e:
-                        logger.warning(f"Failed to cancel run {run.id} on thread {thread_id}: {str(e)}")
-    except Exception as e:
-        logger.error(f"Error cancelling runs for user_id={user_id}: {str(e)}")
-
-
-
-@retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=4, max=10),
-    retry=retry_if_exception_type(Exception),
-    before_sleep=lambda retry_state: logger.warning(
-        f"Retrying OpenAI Assistants API request (attempt {retry_state.attempt_number}/3) after {retry_state.idle_for}s due to: {retry_state.outcome.exception()}"
-    )
-)
-async def call_openai(client: AsyncOpenAI, message_text: str, message_id: str, user_id: str, customer_id: str) -> str:
-    """
-    فراخوانی OpenAI Assistants API برای تحلیل املاک با حفظ تاریخچه مکالمه بر اساس customer_id.
-    """
-    try:
-        user_id = str(user_id).strip()
-        customer_id = str(customer_id).strip()
-        logger.debug(f"Normalized user_id={user_id}, customer_id={customer_id} for message_id={message_id}")
-        if not user_id or not customer_id:
-            logger.error(f"Missing user_id or customer_id for message_id={message_id}")
-            return "User ID and Customer ID required for property analysis"
-
-        # فیلتر کردن ورودی
-        message_text = sanitize_input(message_text)
-        if message_text == "Invalid input detected":
-            logger.error(f"Blocked dangerous input for message_id={message_id}")
-            return "Invalid input detected"
-
-        # خواندن مستقیم داده‌های محصولات از دیتابیس
-        products = list(products_collection.find({"user_id": ObjectId(user_id)}))
-        if not products:
-            logger.debug(f"No products found in DB for user_id={user_id}")
-            return "No properties found"
-
-        # خواندن مستقیم پرامپت‌ها از دیتابیس
-        prompts = list(prompts_collection.find({"user_id": ObjectId(user_id)}))
-        if not prompts:
-            logger.debug(f"No prompts found in DB for user_id={user_id}")
-            return "No prompts found"
-
-        # آماده‌سازی داده‌های محصولات به صورت JSON
-        product_data = []
-        for product in products:
-            if not product.get("name") or not product.get("price"):
-                logger.warning(f"Skipping incomplete product: {product.get('_id')}")
-                continue
-            product_data.append({
-                "_id": str(product["_id"]),  # تبدیل ObjectId به رشته
-                "name": product.get("name", ""),
-                "description": product.get("description", ""),
-                "price": product.get("price", 0),
-                "category": product.get("category", ""),
-                "subCategory": product.get("subCategory", None),
-                "isAvailable": product.get("isAvailable", False),
-                "mainImageIndex": product.get("mainImageIndex", 0),
-                "created_at": product.get("created_at").isoformat() if product.get("created_at") and isinstance(product.get("created_at"), datetime) else None,
-                "updated_at": product.get("updated_at").isoformat() if product.get("updated_at") and isinstance(product.get("updated_at"), datetime) else None,
-                "user_id": str(product.get("user_id", "")),  # تبدیل ObjectId به رشته
-                "images": product.get("images", []),
-                "attributes": product.get("attributes", {})
-            })
-
-        # فیلتر محصولات موجود
-        product_data = [p for p in product_data if p["isAvailable"]]
-        if not product_data:
-            logger.debug(f"No available properties found for user_id={user_id}")
-            return "No available properties found"
-
-        # آماده‌سازی پرامپت‌ها
-        key_points = [p["text"] for p in prompts if p.get("type") == "keyPoint"]
-        guidelines = [p["text"] for p in prompts if p.get("type") == "guideline"]
-        warnings = [p["text"] for p in prompts if p.get("type") == "warning"]
-
-        # تبدیل داده‌های پرامپت‌ها به فرمت قابل سریال‌سازی
-        prompts_serializable = []
-        for prompt in prompts:
-            prompt_serializable = {}
-            for k, v in prompt.items():
-                if isinstance(v, ObjectId):
-                    prompt_serializable[k] = str(v)
-                elif isinstance(v, datetime):
-                    prompt_serializable[k] = v.isoformat()
-                elif v is None or isinstance(v, (str, int, float, bool, list, dict)):
-                    prompt_serializable[k] = v
-                else:
-                    prompt_serializable[k] = str(v)  # تبدیل هر نوع غیرمنتظره به رشته
-            prompts_serializable.append(prompt_serializable)
-
-        # محاسبه هش محتوای محصولات و پرامپت‌ها
-        content_json = json.dumps(product_data, sort_keys=True)
-        prompts_json = json.dumps(prompts_serializable, sort_keys=True)
-        content_hash = hashlib.md5((content_json + prompts_json).encode()).hexdigest()
-
-        ai_config = ai_configs_collection.find_one({"user_id": ObjectId(user_id), "auto_response_enabled": True})
-        if not ai_config or not ai_config.get("api_key"):
-            logger.error(f"No valid AI config for user_id={user_id}, message_id={message_id}")
-            return "AI configuration not found"
-
-        # ایجاد کلاینت همزمان برای عملیات فایل و Vector Store
-        sync_client = OpenAI(api_key=ai_config["api_key"])
-
-        # بررسی تغییرات در محصولات یا پرامپت‌ها و ایجاد Assistant جدید در صورت نیاز
-        assistant_id = ai_config.get("assistant_id")
-        stored_hash = ai_config.get("content_hash", "")
-        file_id = ai_config.get("file_id")
-        vector_store_id = ai_config.get("vector_store_id")
-
-        if not assistant_id or stored_hash != content_hash or not file_id:
-            # آپلود فایل JSON جدید
-            new_file_id = await upload_json_file(sync_client, product_data, user_id)
-            
-            # ایجاد Assistant جدید با فایل آپلودشده
-            new_assistant_id, new_vector_store_id = await create_assistant(sync_client, user_id, new_file_id, key_points, guidelines, warnings)
-            await cancel_all_active_runs_for_user(client, user_id)
-
-            # حذف فایل قدیمی اگر وجود داشته باشد
-            if file_id:
-                try:
-                    sync_client.files.delete(file_id)
-                    logger.info(f"Deleted old file_id={file_id} for user_id={user_id}")
-                except Exception as e:
-                    logger.warning(f"Failed to delete old file_id={file_id}: {str(e)}")
-
-            # حذف Vector Store قدیمی اگر وجود داشته باشد
-            if vector_store_id:
-                try:
-                    sync_client.vector_stores.delete(vector_store_id)
-                    logger.info(f"Deleted old vector_store_id={vector_store_id} for user_id={user_id}")
-                except Exception as e:
-                    logger.warning(f"Failed to delete old vector_store_id={vector_store_id}: {str(e)}")
-                    
-            # حذف تمام Threadهای قدیمی برای user_id
-            try:
-                delete_result = conversation_threads_collection.delete_many({"user_id": ObjectId(user_id)})
-                logger.info(f"Deleted {delete_result.deleted_count} old threads for user_id={user_id}")
-            except Exception as e:
-                logger.warning(f"Failed to delete old threads for user_id={user_id}: {str(e)}")
-
-
-            # به‌روزرسانی تنظیمات
-            ai_configs_collection.update_one(
-                {"user_id": ObjectId(user_id), "auto_response_enabled": True},
-                {"$set": {
-                    "assistant_id": new_assistant_id,
-                    "file_id": new_file_id,
-                    "vector_store_id": new_vector_store_id,
-                    "content_hash": content_hash
-                }}
-            )
-            assistant_id = new_assistant_id
-            file_id = new_file_id
-            vector_store_id = new_vector_store_id
-            logger.info(f"Created and stored new assistant_id={assistant_id}, file_id={file_id}, vector_store_id={vector_store_id} for user_id={user_id} due to data change")
-        else:
-            logger.debug(f"Using existing assistant_id={assistant_id}, file_id={file_id} for user_id={user_id}")
-
-        # پیدا کردن یا ایجاد Thread برای مشتری
-        thread_entry = conversation_threads_collection.find_one({"customer_id": ObjectId(customer_id), "user_id": ObjectId(user_id)})
-        if not thread_entry:
-            thread_response = await client.beta.threads.create()
-            thread_id = thread_response.id
-            conversation_threads_collection.insert_one({
-                "customer_id": ObjectId(customer_id),
-                "user_id": ObjectId(user_id),
-                "thread_id": thread_id,
-                "created_at": datetime.utcnow(),
-                "updated_at": datetime.utcnow()
-            })
-            logger.info(f"Created new thread for customer_id={customer_id}, thread_id={thread_id}")
-        else:
-            thread_id = thread_entry["thread_id"]
-            logger.debug(f"Using existing thread for customer_id={customer_id}, thread_id={thread_id}")
-
-        # افزودن پیام به Thread
-        await client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=message_text
-        )
-        logger.debug(f"Message added to thread {thread_id} for user_id={user_id}")
-
-        # اجرای Thread با Assistants API
-        run_response = await client.beta.threads.runs.create_and_poll(
-            thread_id=thread_id,
-            assistant_id=assistant_id,
-            temperature=0.3,
-            timeout=25
-        )
-
-        if run_response.status != "completed":
-            logger.error(f"Run failed for thread_id={thread_id}, message_id={message_id}, status={run_response.status}")
-            return "Could you please clarify your request or question?"
-
-        # گرفتن پاسخ از Thread
-        messages = await client.beta.threads.messages.list(thread_id=thread_id, run_id=run_response.id)
-        response_text = ""
-        for msg in messages.data:
-            if msg.role == "assistant":
-                response_text += msg.content[0].text.value + "\n"
-        response_text = response_text.strip()
-        if not response_text:
-            logger.error(f"No assistant response found for thread_id={thread_id}, message_id={message_id}")
-            return "Could you please clarify your request or question?"
-
-        logger.info(f"Assistants API response for user_id={user_id}, customer_id={customer_id}, message_id={message_id}: {response_text}")
-
-        # به‌روزرسانی زمان Thread
-        conversation_threads_collection.update_one(
-            {"customer_id": ObjectId(customer_id), "user_id": ObjectId(user_id)},
-            {"$set": {"updated_at": datetime.utcnow()}}
-        )
-
-        return response_text
-
-    except Exception as e:
-        logger.error(f"Error in call_openai for user_id={user_id}, customer_id={customer_id}, message_id={message_id}: {str(e)}")
-        return "Could you please clarify your request or question?"
-
-import random  # اضافه کردن برای انتخاب رندوم
-
-async def send_ai_response(user_id: str, config_name: str, customer_id: str, ai_response: str) -> None:
-    try:
-        whatsapp_config = whatsapp_configs_collection.find_one({"name": config_name, "user_id": ObjectId(user_id)})
-        if not whatsapp_config:
-            logger.error(f"No WhatsApp config found for configName: {config_name}, user_id={user_id}")
-            raise ValueError("WhatsApp config not found")
-
-
-        sender = {
-            "name": whatsapp_config["name"],
-            "phone_number": whatsapp_config["phone_number"]
-        }
-        phone_number_id = whatsapp_config["phone_number_id"]
-        access_token = whatsapp_config["access_token"]
-
-        customer = customers_collection.find_one({"_id": ObjectId(customer_id)})
-        if not customer:
-            logger.error(f"Customer not found: {customer_id}")
-            raise ValueError("Customer not found")
-
-        recipient = {
-            "type": "customer",
-            "id": customer_id,
-            "name": customer["full_name"],
-            "whatsapp_number": customer["whatsapp_number"],
-            "group_id": str(customer["group_id"]) if customer.get("group_id") else None
-        }
-        to_number = recipient["whatsapp_number"].replace("+", "") if recipient["whatsapp_number"].startswith("+") else recipient["whatsapp_number"]
-
-        now = datetime.utcnow()
-        message = {
-            "sender": sender,
-            "recipient": recipient,
-            "title": "",
-            "text": None,
-            "files": [],
-            "template_type": None,
-            "template_id": None,
-            "template_name": None,
-            "whatsapp_message_ids": [],
-            "status": "Sent",
-            "created_at": now,
-            "updated_at": now,
-            "user_id": ObjectId(user_id)
-        }
-
-        headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-        message_url = f"https://graph.facebook.com/v22.0/{phone_number_id}/messages"
-
-        # تغییر جدید: بررسی برای "(Order temp)" و دو URL با انتخاب رندوم رسانه
-        if "co temp" in ai_response:
-            # استخراج URLها
-            all_urls = re.findall(r'(https?://\S+)', ai_response, re.IGNORECASE)
-            media_url_pattern = r'(https?://\S+\.(?:jpg|jpeg|png|pdf|mp4|ogg|mp3))'
-            media_urls = re.findall(media_url_pattern, ai_response, re.IGNORECASE)
-            
-            # بررسی وجود دقیقاً دو URL و حداقل یک URL رسانه‌ای
-            if len(all_urls) == 2 and len(media_urls) >= 1:
-                # انتخاب رندوم یک URL رسانه‌ای
-                media_url = random.choice(media_urls)
-                # پیدا کردن URL غیررسانه‌ای
-                non_media_url = next(url for url in all_urls if url not in media_urls)
-                
-                try:
-                    # تنظیمات تمپلت
-                    template_name = "order_temp"
-                    template_type = "approved"
-                    template_id = template_name
-                    waba_id = whatsapp_config.get("waba_id")
-
-                    # بررسی وجود و وضعیت تمپلت
-                    template_url = f"https://graph.facebook.com/v22.0/{waba_id}/message_templates"
-                    async with httpx.AsyncClient() as client:
-                        template_response = await client.get(template_url, headers=headers)
-                        if template_response.status_code != 200:
-                            logger.error(f"Failed to fetch templates for waba_id={waba_id}: {template_response.json()}")
-                            raise ValueError(f"Failed to fetch templates: {template_response.json()}")
-                        templates = template_response.json().get("data", [])
-                        template = next((t for t in templates if t["name"] == template_name and t["language"] == "en_US"), None)
-                        if not template:
-                            logger.error(f"Template {template_name} with language en_US not found for waba_id={waba_id}")
-                            raise ValueError(f"Template {template_name} with language en_US not found")
-                        if template.get("status") != "APPROVED":
-                            logger.error(f"Template {template_name} is not approved: status={template['status']}")
-                            raise ValueError(f"Template {template_name} is not approved")
-
-                    # دانلود و آپلود رسانه برای هدر
-                    async with httpx.AsyncClient() as client:
-                        response = await client.get(media_url, timeout=15)
-                        if response.status_code != 200:
-                            logger.error(f"Failed to download media from {media_url}: {response.status_code}")
-                            raise ValueError(f"Failed to download media from {media_url}")
-
-                        file_ext = os.path.splitext(media_url)[1].lower()
-                        temp_file_path = os.path.join("uploads/messages", f"temp_media_{uuid.uuid4().hex}{file_ext}")
-                        os.makedirs("uploads/messages", exist_ok=True)
-                        with open(temp_file_path, "wb") as f:
-                            f.write(response.content)
-
-                        media_id = await upload_file_to_whatsapp(temp_file_path, phone_number_id, access_token, is_pdf=(file_ext == ".pdf"))
-                        os.unlink(temp_file_path)
-                        if not media_id:
-                            logger.error(f"Failed to upload media from {media_url} to WhatsApp")
-                            raise ValueError(f"Failed to upload media from {media_url}")
-
-                    # تعیین نوع رسانه برای هدر
-                    file_type = "document" if file_ext == ".pdf" else "image" if file_ext in [".jpg", ".jpeg", ".png"] else "video" if file_ext == ".mp4" else "audio"
-                    header_component = {
-                        "type": "header",
-                        "parameters": [
-                            {
-                                "type": file_type,
-                                file_type: {"id": media_id}
-                            }
-                        ]
-                    }
-                    if file_ext == ".pdf":
-                        header_component["parameters"][0][file_type]["filename"] = f"Media{file_ext}"
-
-                    # تنظیم دکمه با URL غیررسانه‌ای
-                    button_component = {
-                        "type": "button",
-                        "sub_type": "url",
-                        "index": 0,  # فرض می‌کنیم دکمه اول در تمپلت
-                        "parameters": [
-                            {
-                                "type": "text",
-                                "text": non_media_url
-                            }
-                        ]
-                    }
-
-                    # ساخت payload برای تمپلت
-                    payload = {
-                        "messaging_product": "whatsapp",
-                        "recipient_type": "individual",
-                        "to": to_number,
-                        "type": "template",
-                        "template": {
-                            "name": template_name,
-                            "language": {"code": "en_US"},
-                            "components": [header_component, button_component]
-                        }
-                    }
-
-                    # ارسال درخواست
-                    async with httpx.AsyncClient() as client:
-                        response = await client.post(message_url, headers=headers, json=payload)
-                        if response.status_code == 200:
-                            message_id = response.json().get("messages", [{}])[0].get("id")
-                            if not message_id:
-                                logger.error(f"No message_id returned for template {template_name} to {to_number}")
-                                raise ValueError("No message_id returned from WhatsApp API")
-                            
-                            # ثبت پیام در دیتابیس (فقط نام تمپلت)
-                            message["text"] = ai_response
-                            message["template_type"] = template_type
-                            message["template_name"] = template_name
-                            message["template_id"] = template_id
-                            message["whatsapp_message_ids"] = [{"message_id": message_id}]
-                            messages_collection.insert_one(message)
-                            logger.info(f"Order template {template_name} with media and URL button sent for customer_id={customer_id}, message_id={message_id}")
-                            return  # خروج زودهنگام
-                        else:
-                            logger.error(f"Failed to send template {template_name} to {to_number}: {response.json()}")
-                            raise ValueError(f"Failed to send template: {response.json()}")
-                except Exception as e:
-                    logger.error(f"Error sending template {template_name} for customer_id={customer_id}: {str(e)}")
-                    raise HTTPException(status_code=500, detail=f"Failed to send order template: {str(e)}")
-
-        # ادامه منطق اصلی برای ارسال پیام متنی، صوتی یا رسانه
-        # بررسی شرایط تبدیل به صوت
-        if (
-            ai_response and
-            not re.search(r'\d', ai_response) and
-            not re.search(r'(https?://\S+|www\.\S+)', ai_response) and
-            not re.search(r'[\+\-\*/=]', ai_response) and
-            len(ai_response) < 160
-        ):
-            logger.debug(f"Converting response to audio: {ai_response}")
-            async with AsyncOpenAI(api_key=check_ai_config()["api_key"]) as client:
-                audio_data = await text_to_speech(ai_response, client)
-                if audio_data:
-                    temp_audio_path = os.path.join("uploads/messages", f"temp_audio_{uuid.uuid4().hex}.ogg")
-                    os.makedirs("uploads/messages", exist_ok=True)
-                    with open(temp_audio_path, "wb") as f:
-                        f.write(audio_data.read())
-
-                    media_id = await upload_file_to_whatsapp(temp_audio_path, phone_number_id, access_token)
-                    if media_id:
-                        payload = {
-                            "messaging_product": "whatsapp",
-                            "recipient_type": "individual",
-                            "to": to_number,
-                            "type": "audio",
-                            "audio": {"id": media_id}
-                        }
-                        async with httpx.AsyncClient() as client:
-                            response = await client.post(message_url, headers=headers, json=payload)
-                            os.unlink(temp_audio_path)
-                            if response.status_code == 200:
-                                message_id = response.json().get("messages", [{}])[0].get("id")
-                                message["text"] = ai_response
-                                message["files"] = [f"audio_{media_id}.ogg"]
-                                message["whatsapp_message_ids"] = [{"message_id": message_id}]
-                                messages_collection.insert_one(message)
-                                logger.info(f"AI audio response sent and saved for customer_id={customer_id}, message_id={message_id}")
-                                return
-                            else:
-                                logger.error(f"Failed to send audio message: {response.json()}")
-                                raise ValueError(f"Failed to send audio message: {response.json()}")
-                    else:
-                        os.unlink(temp_audio_path)
-                        logger.error("Failed to upload audio to WhatsApp")
-                        raise ValueError("Failed to upload audio")
-
-
-
-        # پردازش URLهای رسانه
-        media_urls = re.findall(r'(https?://\S+\.(?:jpg|jpeg|png|pdf|mp4|ogg|mp3))', ai_response, re.IGNORECASE)
-        sent_media = False
-        if media_urls:
-            async with httpx.AsyncClient() as client:
-                for media_url in media_urls:
-                    try:
-                        response = await client.get(media_url, timeout=15)
-                        if response.status_code != 200:
-                            logger.warning(f"Failed to download media from {media_url}")
-                            continue
-
-                        file_ext = os.path.splitext(media_url)[1].lower()
-                        temp_file_path = os.path.join("uploads/messages", f"temp_media_{uuid.uuid4().hex}{file_ext}")
-                        os.makedirs("uploads/messages", exist_ok=True)
-                        with open(temp_file_path, "wb") as f:
-                            f.write(response.content)
-
-                        media_id = await upload_file_to_whatsapp(temp_file_path, phone_number_id, access_token, is_pdf=(file_ext == ".pdf"))
-                        if media_id:
-                            file_type = "document" if file_ext == ".pdf" else "image" if file_ext in [".jpg", ".jpeg", ".png"] else "video" if file_ext == ".mp4" else "audio"
-                            payload = {
-                                "messaging_product": "whatsapp",
-                                "recipient_type": "individual",
-                                "to": to_number,
-                                "type": file_type,
-                                file_type: {"id": media_id}
-                            }
-                            if file_ext == ".pdf":
-                                payload[file_type]["filename"] = f"Media{file_ext}"
-                            response = await client.post(message_url, headers=headers, json=payload)
-                            os.unlink(temp_file_path)
-                            if response.status_code == 200:
-                                message_id = response.json().get("messages", [{}])[0].get("id")
-                                message["text"] = ai_response
-                                message["files"] = [f"{file_type}_{media_id}{file_ext}"]
-                                message["title"] = "Media"
-                                message["whatsapp_message_ids"] = [{"message_id": message_id}]
-                                messages_collection.insert_one(dict(message))  # کپی پیام برای جلوگیری از تداخل
-                                logger.info(f"AI {file_type} response sent and saved for customer_id={customer_id}, message_id={message_id}")
-                                sent_media = True
-                            else:
-                                logger.error(f"Failed to send {file_type} message: {response.json()}")
-                                continue
-                        else:
-                            os.unlink(temp_file_path)
-                            logger.error(f"Failed to upload media from {media_url}")
-                            continue
-                    except Exception as e:
-                        if os.path.exists(temp_file_path):
-                            os.unlink(temp_file_path)
-                        logger.error(f"Error processing media from {media_url}: {str(e)}")
-                        continue
-
-
-
-        # حذف URLها از متن اصلی برای ارسال پیام متنی
-        text_to_send = ai_response
-        if media_urls:
-            for url in media_urls:
-                text_to_send = text_to_send.replace(url, "").strip()
-        text_to_send = text_to_send.strip()
-
-        # ارسال پیام متنی اگر متن غیرخالی وجود داشته باشد
-        if text_to_send:
-            message["text"] = text_to_send
-            payload = {
-                "messaging_product": "whatsapp",
-                "recipient_type": "individual",
-                "to": to_number,
-                "type": "text",
-                "text": {"body": text_to_send}
-            }
-            async with httpx.AsyncClient() as client:
-                response = await client.post(message_url, headers=headers, json=payload)
-                if response.status_code == 200:
-                    message_id = response.json().get("messages", [{}])[0].get("id")
-                    message["whatsapp_message_ids"] = [{"message_id": message_id}]
-                    if sent_media:
-                        message["files"] = []  # فایل‌ها قبلاً برای رسانه ذخیره شده‌اند
-                        message["title"] = ""
-                    messages_collection.insert_one(dict(message))
-                    logger.info(f"AI text response sent and saved for customer_id={customer_id}, message_id={message_id}")
-                else:
-                    logger.error(f"Failed to send text message: {response.json()}")
-                    raise ValueError(f"Failed to send text message: {response.json()}")
-
-    except Exception as e:
-        logger.error(f"Error sending AI response for customer_id={customer_id}: {str(e)}")
-        raise
-
-def mark_message_processed(message_id: str, conversation_id: str, config_id: str) -> None:
-    try:
-        now = datetime.utcnow()
-        processed_messages_collection.insert_one({
-            "messageId": message_id,
-            "processed_at": now,
-            "conversation_id": conversation_id,
-            "config_id": config_id
-        })
-        logger.debug(f"Marked message {message_id} as processed")
-    except Exception as e:
-        logger.error(f"Error marking message {message_id} as processed: {str(e)}")
-
-async def read_message(phone_number_id: str, access_token: str, message_id: str) -> dict:
-    try:
-        url = f"https://graph.facebook.com/v22.0/{phone_number_id}/messages"
-        headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-        data = {
-            "messaging_product": "whatsapp",
-            "status": "read",
-            "message_id": message_id
-        }
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, headers=headers, json=data)
-            return response.json()
-    except Exception as e:
-        logger.error(f"Error marking message {message_id} as read: {str(e)}")
-        return {"error": str(e)} 
-
-def convert_mp3_to_whatsapp_voice(mp3_data: BytesIO) -> Optional[BytesIO]:
-    try:
-        mp3_data.seek(0)
-        process = subprocess.Popen(
-            ["ffmpeg", "-i", "pipe:0", "-c:a", "libopus", "-b:a", "16k", "-ar", "48000", "-ac", "1", "-application", "voip", "-f", "ogg", "pipe:1"],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
-        )
-        ogg_data, _ = process.communicate(input=mp3_data.read())
-        return BytesIO(ogg_data)
-    except Exception as e:
-        logger.error(f"Error converting MP3 to OGG: {str(e)}")
-        return None
-
-async def text_to_speech(text: str, openai_client: AsyncOpenAI) -> Optional[BytesIO]:
-    try:
-        response = await openai_client.audio.speech.create(
-            model="gpt-4o-mini-tts",
-            instructions="Speak in an energetic and positive tone.",
-            speed=0.9,
-            voice="ash",
-            input=text
-        )
-        audio_mp3 = BytesIO(response.content)
-        audio_mp3.seek(0)
-        return convert_mp3_to_whatsapp_voice(audio_mp3)
-    except Exception as e:
-        logger.error(f"Error in text_to_speech: {str(e)}")
-        return None
-
-async def upload_file_to_whatsapp(file_path: str, phone_number_id: str, access_token: str, is_pdf: bool = False, title: str = None) -> Optional[str]:
-    upload_url = f"https://graph.facebook.com/v22.0/{phone_number_id}/media"
-    headers = {"Authorization": f"Bearer {access_token}"}
-    file_extension = os.path.splitext(file_path)[1].lower()
-    mime_types = {
-        ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png", ".webp": "image/webp",
-        ".pdf": "application/pdf", ".mp4": "video/mp4", ".ogg": "audio/ogg", ".mp3": "audio/mpeg"
-    }
-    mime_type = mime_types.get(file_extension, "application/octet-stream")
-    upload_filename = f"{title}{file_extension}" if is_pdf and title else os.path.basename(file_path)
-    
-    async with httpx.AsyncClient() as client:
-        with open(file_path, "rb") as file:
-            files = {
-                "file": (upload_filename, file, mime_type),
-                "messaging_product": (None, "whatsapp")
-            }
-            response = await client.post(upload_url, headers=headers, files=files)
-        if response.status_code == 200:
-            return response.json().get("id")
-        logger.error(f"Error uploading file {file_path}: {response.json()}")
-        return None
\ No newline at end of file
+﻿# ai_response.py
+import httpx
+import os
+import re
+from io import BytesIO
+import uuid
+import time
+import logging
+from datetime import datetime, timedelta
+from fastapi import HTTPException
+from openai import AsyncOpenAI, OpenAI
+from typing import Optional, Dict, Any, Callable, Awaitable, AsyncIterator, Union
+from pathlib import Path
+from bson import ObjectId
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+from pymongo.errors import OperationFailure, DuplicateKeyError
+from database import (
+    ai_configs_collection, whatsapp_configs_collection, processed_messages_collection,
+    messages_collection, customers_collection, products_collection, prompts_collection,
+    conversation_threads_collection
+)
+from auth import get_user_token
+import asyncio
+import json
+import hashlib
+import threading
+import atexit
+import functools
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import random
+import numpy as np
+
+
+
+# تنظیم لاگینگ
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler('ai_response.log'),
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger(__name__)
+
+##################################################################################
+
+# متریک‌های داخلی با خروجی متنی سازگار با Prometheus (بدون وابستگی خارجی)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in labels.items()) + "}"
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(dict(zip(self.labelnames, key)))} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values: Dict[tuple, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            series = self._values.setdefault(key, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in self._values.items():
+                labels = dict(zip(self.labelnames, key))
+                for bound, count in zip(self.buckets, series["buckets"]):
+                    lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': str(bound)})} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {series['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {series['sum']}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {series['count']}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: list = []
+        self._collectors: list[Callable[[], list[str]]] = []
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector: Callable[[], list[str]]) -> None:
+        """
+        collector در زمان render صدا زده می‌شود؛ برای آمارهایی که خود کش‌ها نگه می‌دارند
+        """
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+stage_seconds = metrics.histogram(
+    "ai_response_stage_seconds", "Latency of each stage of the reply pipeline", ("pipeline", "stage")
+)
+openai_tokens_total = metrics.counter(
+    "ai_response_openai_tokens_total", "OpenAI tokens used by assistant runs", ("user_id", "type")
+)
+local_answers_total = metrics.counter(
+    "ai_response_local_answers_total", "Messages answered without an assistant run", ("intent",)
+)
+
+@contextmanager
+def stage_timer(pipeline: str, stage: str):
+    """
+    اندازه‌گیری زمان یک مرحله و ثبت آن در هیستوگرام ai_response_stage_seconds (حتی در صورت خطا)
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, pipeline=pipeline, stage=stage)
+
+def render_metrics() -> str:
+    """
+    خروجی متنی همه متریک‌ها برای endpoint /metrics
+    """
+    return metrics.render()
+
+##################################################################################
+
+# لایه داده غیرهمزمان: فراخوانی‌های PyMongo روی یک executor اختصاصی اجرا می‌شوند تا event loop بلاک نشود
+MONGO_EXECUTOR_WORKERS = int(os.getenv("MONGO_EXECUTOR_WORKERS", "32"))
+_mongo_executor = ThreadPoolExecutor(max_workers=MONGO_EXECUTOR_WORKERS, thread_name_prefix="mongo")
+
+async def run_db(func: Callable, *args, **kwargs):
+    """
+    اجرای یک تابع همزمان دیتابیس روی executor مخصوص Mongo و برگرداندن نتیجه به صورت awaitable
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_mongo_executor, functools.partial(func, *args, **kwargs))
+
+class AsyncCollection:
+    """
+    پوشش awaitable روی یک collection از PyMongo؛ cursorها داخل executor به لیست تبدیل می‌شوند
+    """
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def find_one(self, *args, **kwargs):
+        return await run_db(self.collection.find_one, *args, **kwargs)
+
+    async def find(self, *args, **kwargs) -> list:
+        return await run_db(lambda: list(self.collection.find(*args, **kwargs)))
+
+    async def insert_one(self, *args, **kwargs):
+        return await run_db(self.collection.insert_one, *args, **kwargs)
+
+    async def insert_many(self, *args, **kwargs):
+        return await run_db(self.collection.insert_many, *args, **kwargs)
+
+    async def update_one(self, *args, **kwargs):
+        return await run_db(self.collection.update_one, *args, **kwargs)
+
+    async def update_many(self, *args, **kwargs):
+        return await run_db(self.collection.update_many, *args, **kwargs)
+
+    async def delete_one(self, *args, **kwargs):
+        return await run_db(self.collection.delete_one, *args, **kwargs)
+
+    async def delete_many(self, *args, **kwargs):
+        return await run_db(self.collection.delete_many, *args, **kwargs)
+
+    async def count_documents(self, *args, **kwargs) -> int:
+        return await run_db(self.collection.count_documents, *args, **kwargs)
+
+    async def find_one_and_update(self, *args, **kwargs):
+        return await run_db(self.collection.find_one_and_update, *args, **kwargs)
+
+    async def aggregate(self, *args, **kwargs) -> list:
+        return await run_db(lambda: list(self.collection.aggregate(*args, **kwargs)))
+
+async_ai_configs_collection = AsyncCollection(ai_configs_collection)
+async_whatsapp_configs_collection = AsyncCollection(whatsapp_configs_collection)
+async_processed_messages_collection = AsyncCollection(processed_messages_collection)
+async_messages_collection = AsyncCollection(messages_collection)
+async_customers_collection = AsyncCollection(customers_collection)
+async_products_collection = AsyncCollection(products_collection)
+async_prompts_collection = AsyncCollection(prompts_collection)
+async_conversation_threads_collection = AsyncCollection(conversation_threads_collection)
+
+PROCESSED_MESSAGE_TTL = int(os.getenv("PROCESSED_MESSAGE_TTL", str(7 * 24 * 3600)))
+
+# ایندکس‌های مورد نیاز کوئری‌های مسیر داغ؛ در startup ساخته و بررسی می‌شوند
+REQUIRED_INDEXES = [
+    (products_collection, [("user_id", 1), ("isAvailable", 1)], {}),
+    (conversation_threads_collection, [("customer_id", 1), ("user_id", 1)], {}),
+    (conversation_threads_collection, [("user_id", 1), ("updated_at", -1)], {}),
+    (processed_messages_collection, [("messageId", 1)], {"unique": True}),
+    (processed_messages_collection, [("processed_at", 1)], {"expireAfterSeconds": PROCESSED_MESSAGE_TTL}),
+]
+
+def _find_index(existing: dict, keys: list) -> Optional[tuple]:
+    # جهت ایندکس‌های text/2dsphere/hashed رشته است؛ مقایسه بدون تبدیل نوع انجام می‌شود (1.0 == 1)
+    for name, index in existing.items():
+        if list(index["key"]) == keys:
+            return name, index
+    return None
+
+def _remove_duplicates(collection, keys: list) -> int:
+    """
+    حذف اسناد تکراری (به جز اولین سند هر مقدار کلید) تا ساخت ایندکس unique با E11000 شکست نخورد
+    """
+    group_id = {field.replace(".", "_"): f"${field}" for field, _ in keys}
+    duplicates = collection.aggregate([
+        {"$sort": {"_id": 1}},
+        {"$group": {"_id": group_id, "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True)
+    removed = 0
+    for duplicate in duplicates:
+        removed += collection.delete_many({"_id": {"$in": duplicate["ids"][1:]}}).deleted_count
+    return removed
+
+def _replace_index(collection, name: str, index: dict, keys: list, options: dict) -> None:
+    """
+    جایگزینی ایندکس با همان کلید و تنظیمات جدید؛ ایندکس قبلی فقط بعد از آماده شدن داده‌ها حذف
+    و اگر ساخت ایندکس جدید شکست بخورد با همان تنظیمات قبلی دوباره ساخته می‌شود
+    """
+    if options.get("unique"):
+        removed = _remove_duplicates(collection, keys)
+        if removed:
+            logger.warning(f"Removed {removed} duplicate documents from {collection.name} before building unique index {keys}")
+    previous_options = {option: value for option, value in index.items() if option not in ("key", "v", "ns")}
+    collection.drop_index(name)
+    try:
+        collection.create_index(keys, **options)
+    except OperationFailure:
+        collection.create_index(keys, **previous_options)
+        raise
+
+async def ensure_indexes() -> None:
+    """
+    هوک startup: ساخت ایندکس‌های تعریف‌شده و بررسی اینکه واقعا با همان تنظیمات روی collection وجود دارند
+    """
+    for collection, keys, options in REQUIRED_INDEXES:
+        try:
+            try:
+                await run_db(collection.create_index, keys, **options)
+            except OperationFailure as e:
+                # ایندکس قدیمی با همان کلید ولی تنظیمات متفاوت (مثلا messageId بدون unique) جایگزین می‌شود
+                if e.code not in (85, 86):
+                    raise
+                found = _find_index(await run_db(collection.index_information), keys)
+                if found is None:
+                    raise
+                logger.warning(f"Replacing index {found[0]} on {collection.name} with options {options}")
+                await run_db(_replace_index, collection, found[0], found[1], keys, options)
+            found = _find_index(await run_db(collection.index_information), keys)
+            if found is None or any(found[1].get(option) != value for option, value in options.items()):
+                logger.error(f"Index {keys} with options {options} is missing on {collection.name}")
+            else:
+                logger.debug(f"Verified index {keys} on {collection.name}")
+        except Exception as e:
+            # خطای یک ایندکس نباید startup را متوقف کند
+            logger.error(f"Failed to ensure index {keys} on {collection.name}: {str(e)}")
+
+# فیلتر و projection محصولات کامل و موجود؛ فیلتر روی ایندکس user_id+isAvailable اجرا می‌شود
+AVAILABLE_PRODUCT_FILTER = {
+    "isAvailable": True,
+    "name": {"$nin": [None, ""]},
+    "price": {"$nin": [None, "", 0, False]}
+}
+PRODUCT_PROJECTION = {
+    field: 1 for field in (
+        "name", "description", "price", "category", "subCategory", "isAvailable", "mainImageIndex",
+        "created_at", "updated_at", "user_id", "images", "attributes"
+    )
+}
+
+def find_available_products(user_id: str) -> list[dict]:
+    """
+    گرفتن فقط محصولات موجود و کامل (دارای name و price) یک کاربر با فیلدهای مورد نیاز
+    """
+    return list(products_collection.find({"user_id": ObjectId(user_id), **AVAILABLE_PRODUCT_FILTER}, projection=PRODUCT_PROJECTION))
+
+##################################################################################
+
+# مدل embedding به صورت تنبل بارگذاری می‌شود تا import این ماژول سبک بماند
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "intfloat/multilingual-e5-large")
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")  # torch | onnx | openvino
+EMBEDDING_QUANTIZE = os.getenv("EMBEDDING_QUANTIZE", "0") == "1"  # کوانتیزه‌سازی پویای int8 روی CPU
+
+_model = None
+_model_lock = threading.Lock()
+
+def get_model():
+    """
+    بارگذاری مدل SentenceTransformer در اولین استفاده (thread-safe)
+    """
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                from sentence_transformers import SentenceTransformer
+                started = time.perf_counter()
+                if EMBEDDING_BACKEND == "torch":
+                    loaded = SentenceTransformer(EMBEDDING_MODEL_NAME, device="cpu" if EMBEDDING_QUANTIZE else None)
+                    if EMBEDDING_QUANTIZE:
+                        import torch
+                        loaded = torch.quantization.quantize_dynamic(loaded, {torch.nn.Linear}, dtype=torch.qint8)
+                else:
+                    loaded = SentenceTransformer(EMBEDDING_MODEL_NAME, backend=EMBEDDING_BACKEND)
+                _model = loaded
+                logger.info(f"Loaded embedding model {EMBEDDING_MODEL_NAME} (backend={EMBEDDING_BACKEND}, quantized={EMBEDDING_QUANTIZE}) in {time.perf_counter() - started:.2f}s")
+    return _model
+
+
+class EmbeddingBatcher:
+    """
+    صف micro-batching برای model.encode؛ درخواست‌های همزمان در یک forward pass روی thread pool اجرا می‌شوند
+    تا event loop بلاک نشود
+    """
+
+    def __init__(self, max_batch_size: int = 32, max_wait_ms: float = 5.0, workers: int = 1):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embedding")
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    def _ensure_worker(self) -> None:
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+    async def encode(self, texts: list[str]) -> np.ndarray:
+        """
+        encode لیست متن‌ها و برگرداندن embeddingهای نرمال‌شده (numpy) به همان ترتیب
+        درخواست‌های بزرگ (مثل ساخت ایندکس محصولات) تکه‌تکه و هر تکه بعد از تکه قبلی به انتهای صف فرستاده می‌شوند
+        تا encode پیام‌های سایر کاربران بین forward passها اجرا شود
+        """
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        if len(texts) <= self.max_batch_size:
+            return await self._submit(texts)
+        chunks = []
+        for start in range(0, len(texts), self.max_batch_size):
+            chunks.append(await self._submit(texts[start:start + self.max_batch_size]))
+        return np.vstack(chunks)
+
+    async def _submit(self, texts: list[str]) -> np.ndarray:
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((texts, future))
+        return await future
+
+    def _encode_sync(self, texts: list[str]) -> np.ndarray:
+        return get_model().encode(texts, convert_to_numpy=True, normalize_embeddings=True, batch_size=self.max_batch_size)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            size = len(batch[0][0])
+            deadline = loop.time() + self.max_wait
+            # جمع کردن درخواست‌های رسیده تا سقف batch یا پایان زمان انتظار
+            while size < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                size += len(item[0])
+
+            texts = [text for item_texts, _ in batch for text in item_texts]
+            try:
+                embeddings = await loop.run_in_executor(self._executor, self._encode_sync, texts)
+            except Exception as e:
+                logger.error(f"Error encoding batch of {len(texts)} texts: {str(e)}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            offset = 0
+            for item_texts, future in batch:
+                if not future.done():
+                    future.set_result(embeddings[offset:offset + len(item_texts)])
+                offset += len(item_texts)
+
+    async def close(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        self._executor.shutdown(wait=False)
+
+
+embedding_batcher = EmbeddingBatcher(
+    max_batch_size=int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", "32")),
+    max_wait_ms=float(os.getenv("EMBEDDING_MAX_WAIT_MS", "5"))
+)
+
+
+class _DiskEmbeddingTier:
+    """
+    لایه دیسکی کش embedding روی فایل memory-mapped (بافر حلقوی) + ایندکس JSON؛ بعد از ری‌استارت باقی می‌ماند
+    هر سطر digest کلید و بردار خودش را دارد و هنگام خواندن بررسی می‌شود، پس اگر ایندکس بعد از خاموشی ناگهانی
+    قدیمی باشد یا صفحه‌ای نیمه‌نوشته مانده باشد، نتیجه miss است نه بردار یک متن دیگر
+    هر دایرکتوری باید فقط توسط یک پروسه نوشته شود
+    """
+
+    FORMAT_VERSION = 2
+    FLUSH_EVERY = 256
+
+    def __init__(self, directory: str, capacity: int):
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, re.sub(r"[^\w.-]", "_", EMBEDDING_MODEL_NAME))
+        self._vectors_path = base + ".rows"
+        self._index_path = base + ".json"
+        self.capacity = capacity
+        self._vectors: Optional[np.memmap] = None
+        self._rows: Dict[str, int] = {}
+        self._row_keys: Dict[int, str] = {}
+        self._next = 0
+        self._dirty = 0
+        self._snapshot_seq = 0
+        self._written_seq = 0
+        self._write_lock = threading.Lock()
+        self.dim: Optional[int] = None
+        if os.path.exists(self._index_path) and os.path.exists(self._vectors_path):
+            try:
+                with open(self._index_path, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                if meta.get("version") == self.FORMAT_VERSION and meta.get("capacity") == capacity:
+                    self._open(meta["dim"], "r+")
+                    self._rows = meta["rows"]
+                    self._row_keys = {row: key for key, row in self._rows.items()}
+                    self._next = meta["next"]
+            except Exception as e:
+                logger.warning(f"Ignoring unreadable embedding cache at {self._index_path}: {str(e)}")
+
+    def _open(self, dim: int, mode: str) -> None:
+        self.dim = dim
+        dtype = np.dtype([("digest", "V16"), ("stored_at", np.float64), ("vector", np.float32, (dim,))])
+        self._vectors = np.memmap(self._vectors_path, dtype=dtype, mode=mode, shape=(self.capacity,))
+
+    @staticmethod
+    def _digest(key: str, stored_at: float, vector: np.ndarray) -> bytes:
+        payload = key.encode("utf-8") + np.float64(stored_at).tobytes() + np.ascontiguousarray(vector, dtype=np.float32).tobytes()
+        return hashlib.blake2b(payload, digest_size=16).digest()
+
+    def get(self, key: str) -> Optional[tuple[np.ndarray, float]]:
+        """
+        بردار و زمان ذخیره (wall clock) یک کلید؛ سطری که digest آن با کلید نخواند حذف و miss حساب می‌شود
+        """
+        row = self._rows.get(key)
+        if row is None or self._vectors is None:
+            return None
+        record = self._vectors[row]
+        vector = np.array(record["vector"])
+        stored_at = float(record["stored_at"])
+        if bytes(record["digest"]) != self._digest(key, stored_at, vector):
+            logger.warning(f"Discarding embedding cache row {row} that does not match its key")
+            self._rows.pop(key, None)
+            self._row_keys.pop(row, None)
+            return None
+        return vector, stored_at
+
+    def put(self, key: str, vector: np.ndarray, stored_at: float) -> None:
+        if self._vectors is None:
+            self._open(vector.shape[0], "w+")
+        if key in self._rows:
+            return
+        row = self._next
+        old_key = self._row_keys.pop(row, None)
+        if old_key is not None:
+            self._rows.pop(old_key, None)
+        self._vectors[row] = (self._digest(key, stored_at, vector), stored_at, vector)
+        self._rows[key] = row
+        self._row_keys[row] = key
+        self._next = (row + 1) % self.capacity
+        self._dirty += 1
+
+    def needs_flush(self) -> bool:
+        return self._dirty >= self.FLUSH_EVERY
+
+    def snapshot(self) -> Optional[Dict[str, Any]]:
+        """
+        کپی ایندکس برای نوشتن روی دیسک؛ روی event loop گرفته می‌شود تا نوشتن در thread دیگر با put تداخل نکند
+        """
+        if self._vectors is None or not self._dirty:
+            return None
+        self._dirty = 0
+        self._snapshot_seq += 1
+        return {
+            "seq": self._snapshot_seq,
+            "meta": {"version": self.FORMAT_VERSION, "dim": self.dim, "capacity": self.capacity, "next": self._next, "rows": dict(self._rows)}
+        }
+
+    def write(self, snapshot: Dict[str, Any]) -> None:
+        with self._write_lock:
+            # snapshot قدیمی‌تر از آنچه قبلا نوشته شده نباید روی آن بنویسد
+            if snapshot["seq"] <= self._written_seq:
+                return
+            self._vectors.flush()
+            temp_path = self._index_path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot["meta"], f, ensure_ascii=False)
+            os.replace(temp_path, self._index_path)
+            self._written_seq = snapshot["seq"]
+
+    def flush(self) -> None:
+        snapshot = self.snapshot()
+        if snapshot is not None:
+            self.write(snapshot)
+
+
+class EmbeddingCache:
+    """
+    کش متن نرمال‌شده ← embedding با حافظه محدود، حذف LRU/TTL، شمارنده hit/miss و لایه دیسکی اختیاری
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 0, disk_dir: Optional[str] = None, disk_capacity: int = 100000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple[np.ndarray, float]]" = OrderedDict()
+        self._disk = _DiskEmbeddingTier(disk_dir, disk_capacity) if disk_dir else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            vector, stored_at = entry
+            if not self.ttl or time.monotonic() - stored_at < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return vector
+            del self._entries[key]
+        if self._disk is not None:
+            found = self._disk.get(key)
+            if found is not None:
+                vector, stored_at = found
+                age = max(0.0, time.time() - stored_at)
+                # TTL برای لایه دیسکی هم بر اساس زمان ذخیره اصلی اعمال می‌شود
+                if not self.ttl or age < self.ttl:
+                    self.disk_hits += 1
+                    self._store(key, vector, time.monotonic() - age)
+                    return vector
+        self.misses += 1
+        return None
+
+    def put(self, key: str, vector: np.ndarray) -> None:
+        self._store(key, vector, time.monotonic())
+        if self._disk is not None:
+            self._disk.put(key, vector, time.time())
+
+    def _store(self, key: str, vector: np.ndarray, stored_at: float) -> None:
+        self._entries[key] = (vector, stored_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def flush(self) -> None:
+        if self._disk is not None:
+            self._disk.flush()
+
+    async def flush_if_needed(self) -> None:
+        """
+        نوشتن دوره‌ای ایندکس دیسکی بیرون از event loop
+        """
+        if self._disk is not None and self._disk.needs_flush():
+            snapshot = self._disk.snapshot()
+            if snapshot is not None:
+                await asyncio.to_thread(self._disk.write, snapshot)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0
+        }
+
+
+embedding_cache = EmbeddingCache(
+    max_entries=int(os.getenv("EMBEDDING_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("EMBEDDING_CACHE_TTL", "0")),
+    disk_dir=os.getenv("EMBEDDING_CACHE_DIR") or None,
+    disk_capacity=int(os.getenv("EMBEDDING_CACHE_DISK_CAPACITY", "100000"))
+)
+atexit.register(embedding_cache.flush)
+
+def normalize_embedding_text(text: str) -> str:
+    # فقط فاصله‌ها یکسان می‌شوند؛ حروف بزرگ و کوچک برای توکنایزر cased مدل معنا دارند
+    return " ".join(text.split())
+
+async def encode_texts(texts: list[str]) -> np.ndarray:
+    """
+    encode با استفاده از کش؛ فقط متن‌هایی که در کش نیستند به EmbeddingBatcher فرستاده می‌شوند.
+    متن نرمال‌شده فقط کلید کش است و خود متن اصلی encode می‌شود (توکنایزر مدل به حروف بزرگ و کوچک حساس است)
+    """
+    keys = [normalize_embedding_text(t) for t in texts]
+    vectors = [embedding_cache.get(key) for key in keys]
+    missing: Dict[str, str] = {}
+    for key, text, vector in zip(keys, texts, vectors):
+        if vector is None:
+            missing.setdefault(key, text)
+    if missing:
+        fresh = dict(zip(missing, await embedding_batcher.encode(list(missing.values()))))
+        for key, vector in fresh.items():
+            embedding_cache.put(key, vector)
+        await embedding_cache.flush_if_needed()
+        vectors = [vector if vector is not None else fresh[key] for key, vector in zip(keys, vectors)]
+    return np.vstack(vectors)
+
+def prepare(text): return "query: " + text.strip()
+
+buy_intents = [
+    "query: buy", "query: order", "query: purchase", "query: i want to buy",
+    "query: how to buy", "query: can i order", "query: where to buy"
+]
+
+# نمونه‌های هر نیت به سه زبان انگلیسی، عربی و فارسی؛ امتیاز هر نیت بیشترین شباهت به نمونه‌های آن است
+INTENT_PROTOTYPES = {
+    "buy": buy_intents + [
+        "query: أريد أن أشتري", "query: أبغى أطلب", "query: كيف أشتري",
+        "query: می‌خواهم بخرم", "query: می‌خوام سفارش بدم", "query: چطوری بخرم"
+    ],
+    "price": [
+        "query: how much is it", "query: what is the price", "query: how much does it cost",
+        "query: كم سعر", "query: بكم هذا", "query: ما هو السعر",
+        "query: قیمتش چنده", "query: قیمت چقدر است", "query: چند است"
+    ],
+    "availability": [
+        "query: is it available", "query: do you have it in stock", "query: is it in stock",
+        "query: هل هو متوفر", "query: هل عندكم", "query: متوفر الآن",
+        "query: موجود دارید", "query: موجوده", "query: دارید"
+    ],
+    "buy_link": [
+        "query: send me the link to buy", "query: purchase link", "query: where can i order it online",
+        "query: أرسل رابط الشراء", "query: رابط الطلب", "query: ابعث لي الرابط",
+        "query: لینک خرید", "query: لینک سفارش را بفرست", "query: لینکش رو بفرست"
+    ],
+    "location": [
+        "query: where is your store", "query: what is your address", "query: do you have a branch near me",
+        "query: وين موقعكم", "query: ما هو عنوان الفرع", "query: أين أقرب فرع",
+        "query: آدرس فروشگاه کجاست", "query: شعبه نزدیک من کجاست", "query: آدرستون کجاست"
+    ],
+    "human_handoff": [
+        "query: i want to talk to a person", "query: connect me to customer support", "query: can i speak to an agent",
+        "query: أريد التحدث مع موظف", "query: حولني لخدمة العملاء", "query: أبي أكلم شخص",
+        "query: می‌خواهم با اپراتور صحبت کنم", "query: وصلم کن به پشتیبانی", "query: با یک آدم واقعی حرف بزنم"
+    ],
+}
+
+class IntentEngine:
+    """
+    طبقه‌بندی برداری نیت‌ها: نمونه‌های همه نیت‌ها در یک ماتریس از پیش محاسبه‌شده نگه داشته می‌شوند
+    و امتیاز یک دسته پیام با یک ضرب ماتریسی به دست می‌آید
+    """
+
+    def __init__(self, prototypes: Dict[str, list[str]]):
+        self.intents = list(prototypes)
+        self._texts = [text for intent in self.intents for text in prototypes[intent]]
+        # شروع سطرهای هر نیت در ماتریس (نمونه‌های هر نیت پشت سر هم قرار دارند)
+        self._offsets = np.cumsum([0] + [len(prototypes[intent]) for intent in self.intents[:-1]])
+        self._matrix: Optional[np.ndarray] = None
+
+    async def load(self) -> np.ndarray:
+        if self._matrix is None:
+            self._matrix = await encode_texts(self._texts)
+        return self._matrix
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        return await encode_texts([prepare(text) for text in texts])
+
+    async def scores(self, embeddings: np.ndarray) -> np.ndarray:
+        """
+        ماتریس امتیاز (تعداد پیام × تعداد نیت) برای embeddingهای از پیش محاسبه‌شده
+        """
+        matrix = await self.load()
+        similarities = np.atleast_2d(embeddings) @ matrix.T
+        return np.maximum.reduceat(similarities, self._offsets, axis=1)
+
+    async def classify_batch(self, texts: list[str], embeddings: Optional[np.ndarray] = None) -> list[list[tuple[str, float]]]:
+        """
+        نیت‌های مرتب‌شده بر اساس امتیاز برای هر پیام؛ اگر embeddings داده شود encode دوباره انجام نمی‌شود
+        """
+        if embeddings is None:
+            embeddings = await self.embed(texts)
+        scores = await self.scores(embeddings)
+        order = np.argsort(-scores, axis=1)
+        return [[(self.intents[i], float(row[i])) for i in ranked] for row, ranked in zip(scores, order)]
+
+    async def classify(self, text: str, embedding: Optional[np.ndarray] = None) -> list[tuple[str, float]]:
+        return (await self.classify_batch([text], None if embedding is None else embedding[None, :]))[0]
+
+intent_engine = IntentEngine(INTENT_PROTOTYPES)
+
+async def has_buy_intent(user_input: str, threshold: float = 0.8) -> bool:
+    ranked = dict(await intent_engine.classify(user_input))
+    return ranked["buy"] >= threshold
+
+async def warm_up_embeddings() -> None:
+    """
+    هوک اختیاری startup: بارگذاری مدل و embedding نیت‌ها قبل از رسیدن اولین پیام
+    """
+    await asyncio.get_running_loop().run_in_executor(embedding_batcher._executor, get_model)
+    await intent_engine.load()
+
+
+
+
+_buy_products_cache: Dict[str, tuple[tuple, list[dict]]] = {}
+
+async def get_user_products_with_urls(user_id: str, version: Optional[tuple] = None) -> list[dict]:
+    """
+    گرفتن محصولات دارای name و buyurl (داخل attributes) برای یک کاربر؛
+    با version (نسخه کاتالوگ) نتیجه تا تغییر نسخه کاتالوگ از کش برگردانده می‌شود و تصویر با pick_product_image انتخاب می‌شود
+    """
+    cached = _buy_products_cache.get(user_id)
+    if version is not None and cached and cached[0] == version:
+        return cached[1]
+
+    products = await async_products_collection.aggregate([
+        {"$match": {
+            "user_id": ObjectId(user_id),
+            "isAvailable": True,
+            "name": {"$nin": [None, ""]},
+            "attributes.buyurl": {"$exists": True, "$ne": ""}
+        }},
+        {"$project": {
+            "name": 1,
+            "buyurl": "$attributes.buyurl",
+            "images": {"$ifNull": ["$images", []]}
+        }}
+    ])
+
+    result = []
+    for p in products:
+        name = p.get("name")
+        buyurl = (p.get("buyurl") or "").strip()
+        if name and buyurl:
+            result.append({"_id": str(p["_id"]), "name": name, "buyurl": buyurl, "images": p.get("images") or []})
+    if version is not None:
+        _buy_products_cache[user_id] = (version, result)
+    return result
+
+def pick_product_image(product: dict) -> Optional[str]:
+    # هر بار یک تصویر تصادفی از تصاویر محصول
+    images = product.get("images") or []
+    return random.choice(images) if images else None
+
+
+# ایندکس embedding محصولات به تفکیک (scope, user_id)؛ هر سطر با (product_id, هش نام) شناخته می‌شود
+_product_indexes: Dict[tuple, Dict[str, Any]] = {}
+
+def _product_row_key(product: dict) -> tuple[str, str]:
+    name = product["name"].strip()
+    return str(product.get("_id", "")), hashlib.md5(name.encode("utf-8")).hexdigest()
+
+async def get_product_index(user_id: str, products: list[dict], scope: str = "buy", version: Optional[tuple] = None) -> Dict[str, Any]:
+    """
+    ساخت یا به‌روزرسانی تدریجی ایندکس embedding محصولات کاربر؛ فقط محصولات جدید یا تغییرنام‌یافته encode می‌شوند.
+    scope لیست‌های مختلف محصولات یک کاربر (لینک‌دار برای خرید، کل کاتالوگ برای پاسخ محلی) را جدا نگه می‌دارد.
+    با version (نسخه کاتالوگ) تا وقتی نسخه تغییر نکرده هیچ کاری روی لیست محصولات انجام نمی‌شود
+    """
+    index = _product_indexes.get((scope, user_id))
+    if version is not None and index and index["version"] == version:
+        return index
+    keys = [_product_row_key(p) for p in products]
+    if index and index["keys"] == keys:
+        index["version"] = version
+        return index
+
+    rows = index["rows"] if index else {}
+    terms = index["terms"] if index else {}
+    missing = [(key, p["name"].strip()) for key, p in zip(keys, products) if key not in rows]
+    if missing:
+        embeddings = await encode_texts([f"passage: {name}" for _, name in missing])
+        rows = dict(rows)
+        for (key, _), embedding in zip(missing, embeddings):
+            rows[key] = embedding
+        logger.info(f"Encoded {len(missing)} new/changed products into index for user_id={user_id}")
+
+    # حذف سطرهای محصولات حذف‌شده و ساخت ماتریس از پیش محاسبه‌شده و ایندکس لغوی
+    wanted = set(keys)
+    rows = {key: emb for key, emb in rows.items() if key in wanted}
+    terms = {key: terms[key] if key in terms else lexical_terms(p["name"]) for key, p in zip(keys, products)}
+    index = {
+        "version": version,
+        "keys": keys,
+        "names": [p["name"] for p in products],
+        "rows": rows,
+        "terms": terms,
+        "matrix": np.vstack([rows[key] for key in keys]) if keys else None,
+        "lexical": await asyncio.to_thread(build_lexical_index, [terms[key] for key in keys])
+    }
+    _product_indexes[(scope, user_id)] = index
+    return index
+
+
+# نرمال‌سازی عربی/فارسی: حذف اعراب و کشیده، یکسان‌سازی شکل‌های الف، ی، ک و ه، نیم‌فاصله و ارقام
+_ARABIC_DIACRITICS = re.compile(r"[\u064B-\u065F\u0670\u0640]")
+_ARABIC_CHAR_MAP = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ى": "ی", "ي": "ی", "ئ": "ی",
+    "ك": "ک", "ة": "ه", "ۀ": "ه", "ؤ": "و",
+    "\u200c": "",
+    **{digit: str(i) for i, digit in enumerate("٠١٢٣٤٥٦٧٨٩")},
+    **{digit: str(i) for i, digit in enumerate("۰۱۲۳۴۵۶۷۸۹")}
+})
+
+def normalize(text: str) -> str:
+    text = _ARABIC_DIACRITICS.sub("", text.lower().strip()).translate(_ARABIC_CHAR_MAP)
+    return re.sub(r"[^\w\s]", "", text)
+
+def lexical_terms(text: str) -> list[str]:
+    """
+    termهای ایندکس لغوی: کلمه نرمال‌شده (بدون «ال» تعریف) و سه‌حرفی‌های آن برای پوشش پیشوند و پسوندها
+    """
+    terms = []
+    for word in normalize(text).split():
+        if len(word) > 4 and word.startswith("ال"):
+            word = word[2:]
+        terms.append(f"w:{word}")
+        if len(word) >= 3:
+            padded = f"#{word}#"
+            terms.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+    return terms
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+def build_lexical_index(documents: list[list[str]]) -> Dict[str, Any]:
+    """
+    ایندکس معکوس با وزن BM25 از پیش محاسبه‌شده برای هر (term, سطر)؛ امتیاز کوئری فقط جمع این وزن‌هاست.
+    norms امتیاز هر سطر در برابر خودش است تا امتیاز کوئری به «چه سهمی از نام محصول در متن آمده» نرمال شود
+    """
+    lengths = np.array([len(terms) for terms in documents], dtype=np.float32)
+    avgdl = float(lengths.mean()) if len(documents) and lengths.mean() > 0 else 1.0
+    postings: Dict[str, tuple[list, list]] = {}
+    for row, terms in enumerate(documents):
+        counts: Dict[str, int] = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        for term, tf in counts.items():
+            rows, tfs = postings.setdefault(term, ([], []))
+            rows.append(row)
+            tfs.append(tf)
+
+    size = len(documents)
+    weighted = {}
+    for term, (rows, tfs) in postings.items():
+        rows = np.array(rows, dtype=np.int32)
+        tfs = np.array(tfs, dtype=np.float32)
+        idf = np.log(1 + (size - len(rows) + 0.5) / (len(rows) + 0.5))
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[rows] / avgdl)
+        weighted[term] = (rows, (idf * tfs * (BM25_K1 + 1) / (tfs + norm)).astype(np.float32))
+
+    norms = np.zeros(size, dtype=np.float32)
+    for rows, weights in weighted.values():
+        norms[rows] += weights
+    return {"postings": weighted, "norms": norms, "size": size}
+
+# سقف تعداد postingهای خوانده‌شده برای هر کوئری؛ termهای نادرتر (با idf بیشتر) اول خوانده می‌شوند
+LEXICAL_POSTINGS_BUDGET = int(os.getenv("LEXICAL_POSTINGS_BUDGET", "20000"))
+
+def lexical_scores(lexical: Dict[str, Any], terms: list[str]) -> Optional[np.ndarray]:
+    hits = sorted((lexical["postings"][term] for term in set(terms) if term in lexical["postings"]), key=lambda hit: len(hit[0]))
+    if not hits:
+        return None
+    budget = len(hits[0][0])
+    for count, hit in enumerate(hits[1:], start=1):
+        budget += len(hit[0])
+        if budget > LEXICAL_POSTINGS_BUDGET:
+            hits = hits[:count]
+            break
+    rows = np.concatenate([rows for rows, _ in hits])
+    weights = np.concatenate([weights for _, weights in hits])
+    return np.bincount(rows, weights=weights, minlength=lexical["size"])
+
+# وزن BM25 در امتیاز ترکیبی و سقف کاندیداهایی که شباهت کسینوسی برایشان محاسبه می‌شود
+HYBRID_LEXICAL_WEIGHT = float(os.getenv("HYBRID_LEXICAL_WEIGHT", "0.3"))
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "50"))
+
+async def match_best_products(user_text: str, products: list[str], top_k: int = 1, threshold: float = 0.6, strict: bool = True,
+                              index: Optional[Dict[str, Any]] = None, query_embedding: Optional[np.ndarray] = None) -> list[str]:
+    """
+    تطبیق ترکیبی لغوی + معنایی برای پیدا کردن محصول؛ امتیاز نهایی ترکیب BM25 نرمال‌شده و شباهت کسینوسی است.
+    در حالت strict فقط محصولاتی که term مشترک با متن دارند کاندیدا هستند و کسینوس فقط برای همان‌ها محاسبه می‌شود.
+    اگر index داده شود (هم‌ترتیب با products) فقط متن کاربر encode می‌شود و اگر query_embedding هم داده شود هیچ encodeی لازم نیست
+    """
+    if not products:
+        return []
+
+    if index is None or index["matrix"] is None:
+        passages = [f"passage: {name.strip()}" for name in products]
+        index = {"matrix": await encode_texts(passages), "lexical": build_lexical_index([lexical_terms(name) for name in products])}
+
+    query_lexical = lexical_scores(index["lexical"], lexical_terms(user_text))
+    if query_lexical is None and strict:
+        return []
+
+    if strict:
+        candidates = np.flatnonzero(query_lexical)
+        if len(candidates) > HYBRID_CANDIDATES:
+            candidates = candidates[np.argpartition(-query_lexical[candidates], HYBRID_CANDIDATES - 1)[:HYBRID_CANDIDATES]]
+    else:
+        candidates = np.arange(len(products))
+
+    if query_embedding is None:
+        query_embedding = (await encode_texts([prepare(user_text)]))[0]
+
+    # بردارها نرمال شده‌اند، پس ضرب داخلی همان شباهت کسینوسی است
+    scores = index["matrix"][candidates] @ query_embedding
+    if query_lexical is not None:
+        coverage = np.minimum(query_lexical[candidates] / np.maximum(index["lexical"]["norms"][candidates], 1e-9), 1.0)
+        scores = (1 - HYBRID_LEXICAL_WEIGHT) * scores + HYBRID_LEXICAL_WEIGHT * coverage
+
+    top_k = min(top_k, len(scores))
+    top = np.argpartition(-scores, top_k - 1)[:top_k]
+    top = top[np.argsort(-scores[top])]
+
+    result = []
+    for i in top:
+        if scores[i] >= threshold:
+            product_name = products[candidates[i]]
+            logger.debug(f"Product candidate {product_name} scored {scores[i]:.3f}")
+            result.append(product_name)
+    return result
+
+
+
+BUY_INTENT_THRESHOLD = float(os.getenv("BUY_INTENT_THRESHOLD", "0.8"))
+
+async def check_purchase_and_generate_response(message_text: str, user_id: str) -> str | None:
+    """
+    بررسی نیت خرید و پاسخ‌دهی مناسب در صورت تشخیص intent و محصول
+    """
+    # embedding پیام یک بار محاسبه و هم برای نیت و هم برای تطبیق محصول استفاده می‌شود
+    with stage_timer("check_purchase", "intent"):
+        query_embedding = (await intent_engine.embed([message_text]))[0]
+        ranked = await intent_engine.classify(message_text, query_embedding)
+    logger.debug(f"Intents for user_id={user_id}: {ranked[:3]}")
+    scores = dict(ranked)
+    if max(scores["buy"], scores["buy_link"]) < BUY_INTENT_THRESHOLD:
+        return None  # نیت خرید تشخیص داده نشد
+
+    # گرفتن لیست محصولات؛ تا تغییر نسخه کاتالوگ لیست و ایندکس از کش خوانده می‌شوند
+    user_id = str(user_id).strip()
+    with stage_timer("check_purchase", "products_query"):
+        version = catalog_version(await get_provisioning_state(user_id))
+        products = await get_user_products_with_urls(user_id, version)
+    logger.debug(f"Found {len(products)} products with buy links for user_id={user_id}")
+    if not products:
+        return None
+
+    with stage_timer("check_purchase", "product_index"):
+        product_index = await get_product_index(user_id, products, version=version)
+    product_names = product_index["names"]
+    with stage_timer("check_purchase", "match"):
+        matched_product_names = await match_best_products(message_text, product_names, top_k=1, index=product_index, query_embedding=query_embedding)
+    logger.debug(f"Matched products for user_id={user_id}: {matched_product_names}")
+
+    if matched_product_names:
+        # محصول پیدا شد، برگشت لینک خرید + "Order temp"
+        for p in products:
+            if p["name"] in matched_product_names:
+                return f"{p['buyurl']} {pick_product_image(p)}  Order temp"
+
+    # نیت خرید هست ولی اسم محصول نبود → پیشنهاد با مثال رندوم
+    random_product = random.choice(product_names)
+    return (
+        f"يرجى كتابة طلب الشراء بهذا الشكل:\n"
+        f"أرغب في شراء {random_product}\n\n"
+        f"Please write your purchase request like this:\n"
+        f"I want to buy {random_product}"
+    )
+
+
+# پاسخ محلی به پرسش‌های ساده کاتالوگ (قیمت، موجودی، لینک خرید) بدون اجرای run روی Assistants API
+LOCAL_ANSWERS_ENABLED = os.getenv("LOCAL_ANSWERS_ENABLED", "1") == "1"
+LOCAL_INTENT_THRESHOLD = float(os.getenv("LOCAL_INTENT_THRESHOLD", "0.85"))
+LOCAL_INTENT_MARGIN = float(os.getenv("LOCAL_INTENT_MARGIN", "0.02"))
+LOCAL_MATCH_THRESHOLD = float(os.getenv("LOCAL_MATCH_THRESHOLD", "0.85"))
+
+LOCAL_INTENTS = ("price", "availability", "buy_link")
+
+LOCAL_ANSWER_TEMPLATES = {
+    "price": {
+        "en": "The price of {name} is {price}.",
+        "ar": "سعر {name} هو {price}.",
+        "fa": "قیمت {name} {price} است."
+    },
+    "availability": {
+        "en": "Yes, {name} is available.",
+        "ar": "نعم، {name} متوفر.",
+        "fa": "بله، {name} موجود است."
+    },
+    "buy_link": {
+        "en": "You can buy {name} here: {buyurl}",
+        "ar": "يمكنك شراء {name} من هنا: {buyurl}",
+        "fa": "می‌توانید {name} را از اینجا بخرید: {buyurl}"
+    },
+}
+
+def detect_language(text: str) -> str:
+    if re.search(r"[پچژگکی]", text):
+        return "fa"
+    if re.search(r"[\u0600-\u06FF]", text):
+        return "ar"
+    return "en"
+
+async def detect_local_intent(user_input: str, embedding: Optional[np.ndarray] = None) -> Optional[str]:
+    """
+    تشخیص نیت ساختاریافته (قیمت، موجودی، لینک خرید)؛ فقط وقتی امتیاز بالا و با فاصله از نیت دوم باشد
+    """
+    ranked = [(intent, score) for intent, score in await intent_engine.classify(user_input, embedding) if intent in LOCAL_INTENTS]
+    (best_intent, best_score), (_, second_score) = ranked[0], ranked[1]
+    if best_score >= LOCAL_INTENT_THRESHOLD and best_score - second_score >= LOCAL_INTENT_MARGIN:
+        return best_intent
+    return None
+
+def _format_price(price: Any) -> str:
+    if isinstance(price, (int, float)) and not isinstance(price, bool):
+        return f"{price:,.0f}" if float(price).is_integer() else f"{price:,.2f}"
+    return str(price)
+
+async def answer_locally(message_text: str, user_id: str, product_data: list[dict], version: Optional[tuple] = None) -> Optional[str]:
+    """
+    پاسخ قالبی به پرسش‌های ساده درباره یک محصول مشخص از روی product_data؛
+    اگر نیت یا محصول با اطمینان کافی تشخیص داده نشود None برمی‌گردد تا Assistant پاسخ دهد
+    """
+    if not LOCAL_ANSWERS_ENABLED or not product_data:
+        return None
+
+    query_embedding = (await intent_engine.embed([message_text]))[0]
+    intent = await detect_local_intent(message_text, query_embedding)
+    if intent is None:
+        return None
+
+    product_index = await get_product_index(user_id, product_data, scope="catalog", version=version)
+    product_names = product_index["names"]
+    matched = await match_best_products(message_text, product_names, top_k=1, threshold=LOCAL_MATCH_THRESHOLD, index=product_index,
+                                        query_embedding=query_embedding)
+    if not matched:
+        return None
+    product = next(p for p in product_data if p["name"] == matched[0])
+
+    buyurl = (product.get("attributes") or {}).get("buyurl", "").strip()
+    if intent == "buy_link" and not buyurl:
+        return None
+
+    template = LOCAL_ANSWER_TEMPLATES[intent][detect_language(message_text)]
+    local_answers_total.inc(intent=intent)
+    return template.format(name=product["name"].strip(), price=_format_price(product.get("price")), buyurl=buyurl)
+
+################################################################################
+
+def check_ai_config():
+    """
+    چک کردن تنظیمات AI فعال و برگرداندن تنظیمات
+    """
+    return ai_configs_collection.find_one({"auto_response_enabled": True}, projection=AI_CONFIG_PROJECTION)
+
+def sanitize_input(text: str) -> str:
+    """
+    حذف هر چیزی که شبیه کد پایتون یا دستور خطرناک باشد
+    """
+    dangerous_patterns = r'\b(import|eval|exec|os\.|subprocess\.|__import__)\b'
+    if re.search(dangerous_patterns, text, re.IGNORECASE):
+        logger.warning(f"Detected dangerous input: {text}")
+        return "Invalid input detected"
+    sanitized = re.sub(r'[^\w\s,.?!-]', '', text)
+    return sanitized.strip()
+
+
+
+# کاتالوگ به صورت فایل‌های JSON (shard) در Vector Store نگهداری می‌شود: برای کاتالوگ‌های کوچک هر محصول یک فایل
+# و بالاتر از PRODUCT_SHARD_LIMIT هر دسته‌بندی یک فایل، تا نگاشت shards در ai_configs و تعداد فایل‌ها محدود بماند
+VECTOR_STORE_BATCH_SIZE = 500
+SHARD_UPLOAD_CONCURRENCY = int(os.getenv("SHARD_UPLOAD_CONCURRENCY", "8"))
+PRODUCT_SHARD_LIMIT = int(os.getenv("PRODUCT_SHARD_LIMIT", "500"))
+
+# نگاشت shards فقط هنگام بازسازی لازم است و در خواندن‌های مسیر داغ ai_configs حذف می‌شود
+AI_CONFIG_PROJECTION = {"shards": 0}
+
+def group_product_shards(product_data: list[dict]) -> Dict[str, list[dict]]:
+    """
+    گروه‌بندی محصولات در shardها: کلید shard شناسه محصول، یا بالاتر از PRODUCT_SHARD_LIMIT دسته‌بندی
+    (و اگر تعداد دسته‌ها هم از سقف بیشتر باشد، bucket هش دسته‌بندی)
+    """
+    if len(product_data) <= PRODUCT_SHARD_LIMIT:
+        return {p["_id"]: [p] for p in product_data}
+    categories = {p.get("category") or "" for p in product_data}
+    groups: Dict[str, list[dict]] = {}
+    for product in sorted(product_data, key=lambda p: p["_id"]):
+        category = product.get("category") or ""
+        # کلید shard نام فیلد در ai_configs.shards است، پس نام دسته‌بندی (که ممکن است "." یا "$" داشته باشد) هش می‌شود
+        category_hash = hashlib.md5(category.encode()).hexdigest()
+        if len(categories) <= PRODUCT_SHARD_LIMIT:
+            key = f"category:{category_hash}"
+        else:
+            key = f"bucket:{int(category_hash, 16) % PRODUCT_SHARD_LIMIT}"
+        groups.setdefault(key, []).append(product)
+    return groups
+
+def shard_layout(product_count: int) -> str:
+    return "product" if product_count <= PRODUCT_SHARD_LIMIT else "category"
+
+async def upload_json_file(client: OpenAI, data: Any, user_id: str, filename: str = "products.json") -> str:
+    """
+    آپلود داده JSON به OpenAI (بدون فایل موقت) و بازگشت file_id
+    """
+    try:
+        content = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        file_response = await asyncio.to_thread(
+            client.files.create,
+            file=(filename, content, "application/json"),
+            purpose="assistants"
+        )
+        logger.info(f"Uploaded JSON file {filename} ({len(content)} bytes) for user_id={user_id}, file_id={file_response.id}")
+        return file_response.id
+    except Exception as e:
+        logger.error(f"Error uploading JSON file for user_id={user_id}: {str(e)}")
+        raise
+
+async def upload_product_shards(client: OpenAI, shards: Dict[str, list[dict]], user_id: str) -> Dict[str, str]:
+    """
+    آپلود همزمان (با سقف محدود) shardها و بازگشت نگاشت کلید shard ← file_id
+    اگر آپلود یکی از shardها شکست بخورد، فایل‌های آپلودشده بقیه حذف و خطا دوباره raise می‌شود
+    """
+    semaphore = asyncio.Semaphore(SHARD_UPLOAD_CONCURRENCY)
+
+    async def upload(key: str, products: list[dict]) -> tuple[str, str]:
+        async with semaphore:
+            if len(products) == 1 and key == products[0]["_id"]:
+                return key, await upload_json_file(client, products[0], user_id, filename=f"product_{key}.json")
+            filename = f"products_{hashlib.md5(key.encode()).hexdigest()[:12]}.json"
+            return key, await upload_json_file(client, products, user_id, filename=filename)
+
+    results = await asyncio.gather(*(upload(key, products) for key, products in shards.items()), return_exceptions=True)
+    uploaded = dict(result for result in results if not isinstance(result, BaseException))
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        await detach_files(client, None, list(uploaded.values()), user_id)
+        raise errors[0]
+    return uploaded
+
+async def attach_files_to_vector_store(client: OpenAI, vector_store_id: str, file_ids: list[str]) -> None:
+    """
+    اضافه کردن فایل‌ها به Vector Store در batchهای حداکثر ۵۰۰تایی و انتظار برای پایان ایندکس
+    اگر batch کامل نشود یا فایلی در آن ایندکس نشود خطا raise می‌شود تا shardهای قبلی حذف نشوند
+    """
+    for start in range(0, len(file_ids), VECTOR_STORE_BATCH_SIZE):
+        batch = await asyncio.to_thread(
+            client.vector_stores.file_batches.create_and_poll,
+            vector_store_id=vector_store_id,
+            file_ids=file_ids[start:start + VECTOR_STORE_BATCH_SIZE]
+        )
+        failed = getattr(getattr(batch, "file_counts", None), "failed", 0) or 0
+        if batch.status != "completed" or failed:
+            raise RuntimeError(f"Vector store file batch {batch.id} for vector_store_id={vector_store_id} ended with status={batch.status}, failed={failed}")
+
+async def detach_files(client: OpenAI, vector_store_id: Optional[str], file_ids: list[str], user_id: str) -> None:
+    """
+    حذف فایل‌ها از Vector Store و از فضای فایل OpenAI
+    """
+    for file_id in file_ids:
+        try:
+            if vector_store_id:
+                await asyncio.to_thread(client.vector_stores.files.delete, file_id=file_id, vector_store_id=vector_store_id)
+            await asyncio.to_thread(client.files.delete, file_id)
+        except Exception as e:
+            logger.warning(f"Failed to delete file_id={file_id} for user_id={user_id}: {str(e)}")
+
+def build_system_prompt(key_points: list, guidelines: list, warnings: list) -> str:
+    return f"""
+You are an assistant working with a JSON dataset stored in files, one product or one product category per file.
+Follow these prompts to guide your responses:
+
+Key Points:
+{chr(10).join(f"- {kp}" for kp in key_points) if key_points else "None"}
+
+Guidelines:
+{chr(10).join(f"- {gl}" for gl in guidelines) if guidelines else "None"}
+
+Warnings:
+{chr(10).join(f"- {wr}" for wr in warnings) if warnings else "None"}
+
+Important!:Only use the information in the attached files. Do not use any outside knowledge or general world facts. Do not search the web.
+Important!:Keep answers brief, but make sure they still fully address the question.
+Important!:Answer in the same language as the question, using natural conversational writing.
+"""
+
+async def create_assistant(client: OpenAI, user_id: str, file_ids: list[str], key_points: list, guidelines: list, warnings: list) -> tuple[str, str]:
+    system_prompt = build_system_prompt(key_points, guidelines, warnings)
+    vector_store = None
+    try:
+        # ایجاد Vector Store و اتصال فایل‌ها
+        vector_store = await asyncio.to_thread(client.vector_stores.create, name=f"PropertiesVectorStore_{user_id}")
+        # منتظر پایان ایندکس شدن فایل‌ها تا Assistant جدید فقط وقتی آماده است جایگزین شود
+        await attach_files_to_vector_store(client, vector_store.id, file_ids)
+
+        # ایجاد Assistant با اتصال به Vector Store
+        async_client = AsyncOpenAI(api_key=client.api_key)
+        assistant = await async_client.beta.assistants.create(  # همچنان از beta برای assistants استفاده می‌شود
+            name="RealEstateAssistant",
+            instructions=system_prompt,
+            model="gpt-4o-mini",
+            tools=[{"type": "file_search"}],
+            tool_resources={"file_search": {"vector_store_ids": [vector_store.id]}}
+        )
+        logger.info(f"Created new Assistant with ID: {assistant.id} for user_id={user_id}")
+        return assistant.id, vector_store.id
+    except Exception as e:
+        logger.error(f"Error creating Assistant for user_id={user_id}: {str(e)}")
+        if vector_store is not None:
+            try:
+                await asyncio.to_thread(client.vector_stores.delete, vector_store.id)
+            except Exception as cleanup_error:
+                logger.warning(f"Failed to delete vector_store_id={vector_store.id}: {str(cleanup_error)}")
+        raise
+
+# فقط تردهایی که اخیرا فعال بوده‌اند ممکن است run در حال اجرا داشته باشند
+RUN_CANCEL_ACTIVE_WINDOW = float(os.getenv("RUN_CANCEL_ACTIVE_WINDOW", "600"))
+RUN_CANCEL_CONCURRENCY = int(os.getenv("RUN_CANCEL_CONCURRENCY", "16"))
+
+async def cancel_all_active_runs_for_user(client: AsyncOpenAI, user_id: str):
+    """
+    لغو runهای فعال تردهای اخیرا فعال کاربر؛ لیست و لغو runها با همزمانی محدود انجام می‌شود
+    """
+    try:
+        since = datetime.utcnow() - timedelta(seconds=RUN_CANCEL_ACTIVE_WINDOW)
+        user_threads = await async_conversation_threads_collection.find(
+            {"user_id": ObjectId(user_id), "updated_at": {"$gte": since}},
+            projection={"thread_id": 1}
+        )
+        thread_ids = [entry["thread_id"] for entry in user_threads if entry.get("thread_id")]
+        semaphore = asyncio.Semaphore(RUN_CANCEL_CONCURRENCY)
+
+        async def cancel_run(thread_id: str, run_id: str) -> bool:
+            async with semaphore:
+                try:
+                    await client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+                    logger.info(f"Cancelled run {run_id} for thread {thread_id}")
+                    return True
+                except Exception as e:
+                    logger.warning(f"Failed to cancel run {run_id} on thread {thread_id}: {str(e)}")
+                    return False
+
+        async def cancel_thread_runs(thread_id: str) -> int:
+            async with semaphore:
+                try:
+                    runs = await client.beta.threads.runs.list(thread_id=thread_id, limit=10)
+                except Exception as e:
+                    logger.warning(f"Failed to list runs on thread {thread_id}: {str(e)}")
+                    return 0
+            active = [run.id for run in runs.data if run.status in ("queued", "in_progress", "requires_action")]
+            return sum(await asyncio.gather(*(cancel_run(thread_id, run_id) for run_id in active)))
+
+        cancelled = await asyncio.gather(*(cancel_thread_runs(thread_id) for thread_id in thread_ids))
+        logger.info(f"Cancelled {sum(cancelled)} active runs across {len(thread_ids)} recent threads for user_id={user_id}")
+    except Exception as e:
+        logger.error(f"Error cancelling runs for user_id={user_id}: {str(e)}")
+
+
+
+# کش وضعیت provisioning دستیار به تفکیک کاربر؛ مسیر داغ فقط شماره نسخه را چک می‌کند
+PROVISIONING_WATERMARK_INTERVAL = float(os.getenv("PROVISIONING_WATERMARK_INTERVAL", "30"))
+
+_provisioning_cache: Dict[str, Dict[str, Any]] = {}
+_catalog_versions: Dict[str, int] = {}
+_catalog_epoch = 0  # نسخه سراسری؛ با باطل شدن کش همه کاربران زیاد می‌شود
+_catalog_document_owners: Dict[str, str] = {}  # _id محصول/پرامپت ← user_id برای رویدادهای حذف
+_catalog_watchers_healthy: Dict[str, bool] = {}
+_provisioning_lock = threading.Lock()
+_provisioning_inflight: Dict[tuple, asyncio.Task] = {}  # ساخت در حال اجرا به تفکیک (user_id, نسخه)
+provisioning_cache_stats = {"hits": 0, "revalidated": 0, "misses": 0, "shared": 0}
+
+def invalidate_provisioning_cache(user_id: Optional[str] = None) -> None:
+    """
+    باطل کردن کش provisioning بعد از نوشتن محصول یا پرامپت؛ بدون user_id کش همه کاربران باطل می‌شود
+    """
+    global _catalog_epoch
+    with _provisioning_lock:
+        if user_id is None:
+            _catalog_epoch += 1
+            _provisioning_cache.clear()
+            _catalog_document_owners.clear()
+        else:
+            _catalog_versions[user_id] = _catalog_versions.get(user_id, 0) + 1
+
+def _catalog_generation(user_id: str) -> tuple:
+    # باید زیر _provisioning_lock صدا زده شود
+    return _catalog_epoch, _catalog_versions.get(user_id, 0)
+
+def _invalidate_deleted_document(document_id: Any) -> None:
+    """
+    رویداد حذف fullDocument ندارد؛ مالک از روی شناسه‌های وضعیت‌های کش‌شده پیدا می‌شود.
+    سندی که در هیچ وضعیت کش‌شده‌ای نیست فقط می‌تواند روی وضعیت‌های خطا (مثل نبود محصول موجود) اثر بگذارد
+    """
+    with _provisioning_lock:
+        owner = _catalog_document_owners.get(str(document_id))
+        if owner is None:
+            for user_id in [user_id for user_id, state in _provisioning_cache.items() if state.get("error")]:
+                _catalog_versions[user_id] = _catalog_versions.get(user_id, 0) + 1
+            return
+    invalidate_provisioning_cache(owner)
+
+def _catalog_watermark(user_id: str) -> tuple:
+    """
+    watermark ارزان کاتالوگ: تعداد اسناد و آخرین updated_at محصولات و پرامپت‌ها
+    """
+    watermark = []
+    for collection in (products_collection, prompts_collection):
+        latest = collection.find_one({"user_id": ObjectId(user_id)}, projection={"updated_at": 1}, sort=[("updated_at", -1)])
+        watermark.append(collection.count_documents({"user_id": ObjectId(user_id)}))
+        watermark.append(latest.get("updated_at") if latest else None)
+    return tuple(watermark)
+
+def build_provisioning_state(user_id: str) -> Dict[str, Any]:
+    """
+    خواندن محصولات و پرامپت‌ها و محاسبه داده‌های لازم برای ساخت Assistant به همراه هش محتوا
+    """
+    # فقط محصولات موجود و کامل با فیلدهای لازم از دیتابیس خوانده می‌شوند
+    products = find_available_products(user_id)
+    if not products:
+        if products_collection.find_one({"user_id": ObjectId(user_id)}, projection={"_id": 1}) is None:
+            logger.debug(f"No products found in DB for user_id={user_id}")
+            return {"error": "No properties found"}
+        logger.debug(f"No available properties found for user_id={user_id}")
+        return {"error": "No available properties found"}
+
+    # خواندن مستقیم پرامپت‌ها از دیتابیس
+    prompts = list(prompts_collection.find({"user_id": ObjectId(user_id)}))
+    if not prompts:
+        logger.debug(f"No prompts found in DB for user_id={user_id}")
+        return {"error": "No prompts found"}
+
+    # آماده‌سازی داده‌های محصولات به صورت JSON
+    product_data = []
+    for product in products:
+        product_data.append({
+            "_id": str(product["_id"]),  # تبدیل ObjectId به رشته
+            "name": product.get("name", ""),
+            "description": product.get("description", ""),
+            "price": product.get("price", 0),
+            "category": product.get("category", ""),
+            "subCategory": product.get("subCategory", None),
+            "isAvailable": product.get("isAvailable", False),
+            "mainImageIndex": product.get("mainImageIndex", 0),
+            "created_at": product.get("created_at").isoformat() if product.get("created_at") and isinstance(product.get("created_at"), datetime) else None,
+            "updated_at": product.get("updated_at").isoformat() if product.get("updated_at") and isinstance(product.get("updated_at"), datetime) else None,
+            "user_id": str(product.get("user_id", "")),  # تبدیل ObjectId به رشته
+            "images": product.get("images", []),
+            "attributes": product.get("attributes", {})
+        })
+
+    # آماده‌سازی پرامپت‌ها
+    key_points = [p["text"] for p in prompts if p.get("type") == "keyPoint"]
+    guidelines = [p["text"] for p in prompts if p.get("type") == "guideline"]
+    warnings = [p["text"] for p in prompts if p.get("type") == "warning"]
+
+    # تبدیل داده‌های پرامپت‌ها به فرمت قابل سریال‌سازی
+    prompts_serializable = []
+    for prompt in prompts:
+        prompt_serializable = {}
+        for k, v in prompt.items():
+            if isinstance(v, ObjectId):
+                prompt_serializable[k] = str(v)
+            elif isinstance(v, datetime):
+                prompt_serializable[k] = v.isoformat()
+            elif v is None or isinstance(v, (str, int, float, bool, list, dict)):
+                prompt_serializable[k] = v
+            else:
+                prompt_serializable[k] = str(v)  # تبدیل هر نوع غیرمنتظره به رشته
+        prompts_serializable.append(prompt_serializable)
+
+    # محاسبه هش محتوای محصولات و پرامپت‌ها
+    content_json = json.dumps(product_data, sort_keys=True)
+    prompts_json = json.dumps(prompts_serializable, sort_keys=True)
+    content_hash = hashlib.md5((content_json + prompts_json).encode()).hexdigest()
+
+    # هش هر shard برای به‌روزرسانی تدریجی Vector Store
+    shard_hashes = {
+        key: hashlib.md5(json.dumps(products, sort_keys=True).encode()).hexdigest()
+        for key, products in group_product_shards(product_data).items()
+    }
+
+    return {
+        "product_data": product_data,
+        "document_ids": [p["_id"] for p in product_data] + [p["_id"] for p in prompts_serializable if p.get("_id")],
+        "key_points": key_points,
+        "guidelines": guidelines,
+        "warnings": warnings,
+        "content_hash": content_hash,
+        "shard_hashes": shard_hashes,
+        "prompts_hash": hashlib.md5(prompts_json.encode()).hexdigest()
+    }
+
+def catalog_version(state: Dict[str, Any]) -> tuple:
+    """
+    نسخه کاتالوگ یک وضعیت provisioning؛ با هر تغییر محصولات یا پرامپت‌ها (change stream یا watermark) عوض می‌شود
+    """
+    return state.get("generation"), state.get("watermark")
+
+async def get_provisioning_state(user_id: str) -> Dict[str, Any]:
+    """
+    وضعیت provisioning کش‌شده کاربر؛ فقط وقتی نسخه یا watermark کاتالوگ تغییر کرده باشد دوباره ساخته می‌شود
+    """
+    with _provisioning_lock:
+        generation = _catalog_generation(user_id)
+        state = _provisioning_cache.get(user_id)
+    now = time.monotonic()
+
+    watermark = None
+    if state and state["generation"] == generation:
+        # با change stream فعال، نسخه به تنهایی کافی است
+        if all(_catalog_watchers_healthy.get(name) for name in ("products", "prompts")):
+            provisioning_cache_stats["hits"] += 1
+            return state
+        if now - state["checked_at"] < PROVISIONING_WATERMARK_INTERVAL:
+            provisioning_cache_stats["hits"] += 1
+            return state
+        watermark = await run_db(_catalog_watermark, user_id)
+        if watermark == state["watermark"]:
+            state["checked_at"] = now
+            provisioning_cache_stats["revalidated"] += 1
+            return state
+
+    # پیام‌های همزمان یک کاربر روی یک ساخت مشترک منتظر می‌مانند
+    key = (user_id, generation)
+    task = _provisioning_inflight.get(key)
+    if task is None:
+        provisioning_cache_stats["misses"] += 1
+        task = asyncio.create_task(_rebuild_provisioning_state(user_id, generation, watermark, now))
+        _provisioning_inflight[key] = task
+        task.add_done_callback(lambda _: _provisioning_inflight.pop(key, None))
+    else:
+        provisioning_cache_stats["shared"] += 1
+    return await asyncio.shield(task)
+
+async def _rebuild_provisioning_state(user_id: str, generation: tuple, watermark: Optional[tuple], now: float) -> Dict[str, Any]:
+    if watermark is None:
+        watermark = await run_db(_catalog_watermark, user_id)
+    state = await run_db(build_provisioning_state, user_id)
+    state.update({"generation": generation, "watermark": watermark, "checked_at": now})
+    with _provisioning_lock:
+        # اگر حین ساخت کاتالوگ باطل شده باشد، نتیجه ممکن است کهنه باشد و در کش قرار نمی‌گیرد
+        if _catalog_generation(user_id) != generation:
+            logger.debug(f"Discarding provisioning state for user_id={user_id} invalidated during rebuild")
+            return state
+        previous = _provisioning_cache.get(user_id)
+        for document_id in (previous or {}).get("document_ids", []):
+            _catalog_document_owners.pop(document_id, None)
+        for document_id in state.get("document_ids", []):
+            _catalog_document_owners[document_id] = user_id
+        _provisioning_cache[user_id] = state
+    logger.debug(f"Rebuilt provisioning state for user_id={user_id}, generation={generation}")
+    return state
+
+def _watch_catalog_collection(name: str, collection) -> None:
+    pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+    while True:
+        try:
+            with collection.watch(pipeline, full_document="updateLookup") as stream:
+                # وضعیت‌هایی که پیش از باز شدن stream ساخته شده‌اند تغییرات فاصله را ندیده‌اند
+                invalidate_provisioning_cache()
+                _catalog_watchers_healthy[name] = True
+                for change in stream:
+                    owner = (change.get("fullDocument") or {}).get("user_id")
+                    if owner:
+                        invalidate_provisioning_cache(str(owner))
+                    else:
+                        _invalidate_deleted_document((change.get("documentKey") or {}).get("_id"))
+        except OperationFailure as e:
+            _catalog_watchers_healthy[name] = False
+            if e.code == 40573:  # change stream فقط روی replica set پشتیبانی می‌شود
+                logger.info(f"Change streams unavailable for {name}, falling back to updated_at watermark")
+                return
+            logger.warning(f"Change stream on {name} failed: {str(e)}")
+        except Exception as e:
+            _catalog_watchers_healthy[name] = False
+            logger.warning(f"Change stream on {name} failed: {str(e)}")
+        invalidate_provisioning_cache()
+        time.sleep(5)
+
+def start_catalog_change_watcher() -> None:
+    """
+    هوک startup: گوش دادن به change stream محصولات و پرامپت‌ها برای باطل کردن کش provisioning
+    """
+    for name, collection in (("products", products_collection), ("prompts", prompts_collection)):
+        threading.Thread(target=_watch_catalog_collection, args=(name, collection), name=f"catalog-watch-{name}", daemon=True).start()
+
+
+# صف بازسازی پس‌زمینه Assistant: حداکثر یک job برای هر user_id و debounce ویرایش‌های پشت‌سرهم کاتالوگ
+ASSISTANT_REBUILD_DEBOUNCE = float(os.getenv("ASSISTANT_REBUILD_DEBOUNCE", "5"))
+ASSISTANT_REBUILD_LEASE = float(os.getenv("ASSISTANT_REBUILD_LEASE", "300"))
+ASSISTANT_LEASE_POLL_INTERVAL = float(os.getenv("ASSISTANT_LEASE_POLL_INTERVAL", "2"))
+
+_rebuild_tasks: Dict[str, asyncio.Task] = {}
+
+def schedule_assistant_rebuild(user_id: str, debounce: float = ASSISTANT_REBUILD_DEBOUNCE) -> asyncio.Task:
+    """
+    زمان‌بندی بازسازی Assistant در پس‌زمینه؛ درخواست‌های همزمان یک کاربر به همان job متصل می‌شوند
+    """
+    task = _rebuild_tasks.get(user_id)
+    if task is None or task.done():
+        task = asyncio.create_task(_run_assistant_rebuild(user_id, debounce))
+        _rebuild_tasks[user_id] = task
+    return task
+
+async def _acquire_rebuild_lease(user_id: str) -> Optional[str]:
+    """
+    گرفتن lease بازسازی در ai_configs تا workerهای دیگر همزمان بازسازی نکنند؛ توکن مالک lease برگردانده می‌شود
+    """
+    now = datetime.utcnow()
+    owner = uuid.uuid4().hex
+    lease = await async_ai_configs_collection.find_one_and_update(
+        {
+            "user_id": ObjectId(user_id),
+            "auto_response_enabled": True,
+            "$or": [{"rebuild_lease_until": {"$exists": False}}, {"rebuild_lease_until": {"$lt": now}}]
+        },
+        {"$set": {"rebuild_lease_until": now + timedelta(seconds=ASSISTANT_REBUILD_LEASE), "rebuild_lease_owner": owner}},
+        projection={"_id": 1}
+    )
+    return owner if lease is not None else None
+
+async def _renew_rebuild_lease(user_id: str, owner: str) -> None:
+    """
+    تمدید دوره‌ای lease تا بازسازی‌های طولانی (آپلود تعداد زیادی shard) از مدت lease بیشتر نشوند
+    """
+    while True:
+        await asyncio.sleep(ASSISTANT_REBUILD_LEASE / 3)
+        try:
+            renewed = await async_ai_configs_collection.update_one(
+                {"user_id": ObjectId(user_id), "auto_response_enabled": True, "rebuild_lease_owner": owner},
+                {"$set": {"rebuild_lease_until": datetime.utcnow() + timedelta(seconds=ASSISTANT_REBUILD_LEASE)}}
+            )
+            if renewed.matched_count == 0:
+                logger.warning(f"Lost assistant rebuild lease for user_id={user_id}")
+                return
+        except Exception as e:
+            logger.warning(f"Failed to renew assistant rebuild lease for user_id={user_id}: {str(e)}")
+
+async def _wait_for_rebuild_lease(user_id: str) -> None:
+    """
+    انتظار برای ساخت اولین Assistant روی worker دیگر؛ تا ثبت assistant_id یا آزاد/منقضی شدن lease
+    """
+    while True:
+        await asyncio.sleep(ASSISTANT_LEASE_POLL_INTERVAL)
+        ai_config = await async_ai_configs_collection.find_one(
+            {"user_id": ObjectId(user_id), "auto_response_enabled": True},
+            projection={"assistant_id": 1, "vector_store_id": 1, "rebuild_lease_until": 1}
+        )
+        if not ai_config or (ai_config.get("assistant_id") and ai_config.get("vector_store_id")):
+            return
+        lease_until = ai_config.get("rebuild_lease_until")
+        if lease_until is None or lease_until < datetime.utcnow():
+            return
+
+async def _release_rebuild_lease(user_id: str, owner: str) -> None:
+    # فقط اگر lease هنوز متعلق به همین worker باشد آزاد می‌شود
+    await async_ai_configs_collection.update_one(
+        {"user_id": ObjectId(user_id), "auto_response_enabled": True, "rebuild_lease_owner": owner},
+        {"$unset": {"rebuild_lease_until": "", "rebuild_lease_owner": ""}}
+    )
+
+async def _run_assistant_rebuild(user_id: str, debounce: float) -> None:
+    try:
+        # صبر تا نسخه کاتالوگ برای مدت debounce ثابت بماند
+        version = _catalog_versions.get(user_id, 0)
+        while debounce > 0:
+            await asyncio.sleep(debounce)
+            current = _catalog_versions.get(user_id, 0)
+            if current == version:
+                break
+            version = current
+
+        while True:
+            state = await get_provisioning_state(user_id)
+            if state.get("error"):
+                return
+            ai_config = await async_ai_configs_collection.find_one(
+                {"user_id": ObjectId(user_id), "auto_response_enabled": True}, projection=AI_CONFIG_PROJECTION
+            )
+            if not ai_config or not ai_config.get("api_key"):
+                return
+            if ai_config.get("assistant_id") and ai_config.get("shard_layout") and ai_config.get("content_hash") == state["content_hash"]:
+                return
+            lease_owner = await _acquire_rebuild_lease(user_id)
+            if lease_owner is None:
+                logger.info(f"Assistant rebuild for user_id={user_id} is already running on another worker")
+                if ai_config.get("assistant_id") and ai_config.get("vector_store_id"):
+                    return
+                # هنوز Assistantی وجود ندارد و پیام‌ها منتظر اولین ساخت هستند
+                await _wait_for_rebuild_lease(user_id)
+                continue
+            renewer = asyncio.create_task(_renew_rebuild_lease(user_id, lease_owner))
+            try:
+                await rebuild_assistant(user_id, ai_config, state)
+            finally:
+                renewer.cancel()
+                await _release_rebuild_lease(user_id, lease_owner)
+            # اگر کاتالوگ حین ساخت تغییر کرده باشد، حلقه یک دور دیگر اجرا می‌شود
+    except Exception as e:
+        logger.error(f"Error rebuilding assistant for user_id={user_id}: {str(e)}")
+    finally:
+        if _rebuild_tasks.get(user_id) is asyncio.current_task():
+            del _rebuild_tasks[user_id]
+
+async def rebuild_assistant(user_id: str, ai_config: dict, state: Dict[str, Any]) -> None:
+    """
+    به‌روزرسانی Assistant با تغییرات کاتالوگ؛ اگر Vector Store شاردشده وجود داشته باشد فقط shardهای تغییرکرده
+    جابه‌جا می‌شوند، وگرنه Assistant جدید ساخته و به صورت اتمیک جایگزین می‌شود
+    """
+    sync_client = OpenAI(api_key=ai_config["api_key"])
+    if ai_config.get("assistant_id") and ai_config.get("vector_store_id") and ai_config.get("shard_layout"):
+        # Assistant تغییر نمی‌کند، پس runهای در حال اجرا و تاریخچه مکالمه‌ها دست نمی‌خورند
+        await _update_assistant_incrementally(sync_client, user_id, ai_config, state)
+        return
+
+    if not await _replace_assistant(sync_client, user_id, ai_config, state):
+        return
+
+    async with AsyncOpenAI(api_key=ai_config["api_key"]) as async_client:
+        await cancel_all_active_runs_for_user(async_client, user_id)
+
+    # حذف تمام Threadهای قدیمی برای user_id
+    try:
+        delete_result = await async_conversation_threads_collection.delete_many({"user_id": ObjectId(user_id)})
+        logger.info(f"Deleted {delete_result.deleted_count} old threads for user_id={user_id}")
+    except Exception as e:
+        logger.warning(f"Failed to delete old threads for user_id={user_id}: {str(e)}")
+
+async def _update_assistant_incrementally(sync_client: OpenAI, user_id: str, ai_config: dict, state: Dict[str, Any]) -> None:
+    assistant_id = ai_config["assistant_id"]
+    vector_store_id = ai_config["vector_store_id"]
+    stored = await async_ai_configs_collection.find_one({"_id": ai_config["_id"]}, projection={"shards": 1})
+    old_shards = (stored or {}).get("shards", {})
+    shard_hashes = state["shard_hashes"]
+
+    groups = group_product_shards(state["product_data"])
+    changed = {key: products for key, products in groups.items() if old_shards.get(key, {}).get("hash") != shard_hashes[key]}
+    stale_file_ids = [
+        shard["file_id"] for key, shard in old_shards.items()
+        if key not in shard_hashes or shard.get("hash") != shard_hashes[key]
+    ]
+
+    # ابتدا shardهای جدید ایندکس می‌شوند و بعد shardهای قدیمی حذف می‌شوند تا Vector Store هیچ‌وقت خالی نماند
+    uploaded = await upload_product_shards(sync_client, changed, user_id)
+    try:
+        await attach_files_to_vector_store(sync_client, vector_store_id, list(uploaded.values()))
+
+        if ai_config.get("prompts_hash") != state["prompts_hash"]:
+            await asyncio.to_thread(
+                sync_client.beta.assistants.update,
+                assistant_id,
+                instructions=build_system_prompt(state["key_points"], state["guidelines"], state["warnings"])
+            )
+
+        shards = {
+            key: old_shards[key] if key not in uploaded else {"hash": shard_hash, "file_id": uploaded[key]}
+            for key, shard_hash in shard_hashes.items()
+        }
+        # فقط اگر از زمان خواندن ai_config نه Assistant جایگزین شده و نه کاتالوگ دیگری نوشته شده باشد
+        update = await async_ai_configs_collection.update_one(
+            {"_id": ai_config["_id"], "assistant_id": assistant_id, "content_hash": ai_config.get("content_hash")},
+            {"$set": {
+                "shards": shards,
+                "shard_layout": shard_layout(len(state["product_data"])),
+                "prompts_hash": state["prompts_hash"],
+                "content_hash": state["content_hash"]
+            }}
+        )
+    except BaseException:
+        await detach_files(sync_client, vector_store_id, list(uploaded.values()), user_id)
+        raise
+
+    if update.matched_count == 0:
+        logger.warning(f"Assistant for user_id={user_id} changed concurrently, discarding {len(uploaded)} new shards")
+        await detach_files(sync_client, vector_store_id, list(uploaded.values()), user_id)
+        return
+    await detach_files(sync_client, vector_store_id, stale_file_ids, user_id)
+    logger.info(f"Incrementally updated vector_store_id={vector_store_id} for user_id={user_id}: {len(uploaded)} shards added, {len(stale_file_ids)} removed")
+
+async def _replace_assistant(sync_client: OpenAI, user_id: str, ai_config: dict, state: Dict[str, Any]) -> bool:
+    """
+    ساخت Assistant جدید و جایگزینی اتمیک آن؛ اگر Assistant دیگری زودتر جایگزین شده باشد False برمی‌گردد
+    """
+    assistant_id = ai_config.get("assistant_id")
+    vector_store_id = ai_config.get("vector_store_id")
+    stored = await async_ai_configs_collection.find_one({"_id": ai_config["_id"]}, projection={"shards": 1})
+    old_file_ids = [shard["file_id"] for shard in (stored or {}).get("shards", {}).values()]
+    if ai_config.get("file_id"):
+        old_file_ids.append(ai_config["file_id"])  # فایل تکی قدیمی قبل از شاردبندی
+
+    # آپلود shardها و ایجاد Assistant جدید با فایل‌های آپلودشده
+    uploaded = await upload_product_shards(sync_client, group_product_shards(state["product_data"]), user_id)
+    try:
+        new_assistant_id, new_vector_store_id = await create_assistant(
+            sync_client, user_id, list(uploaded.values()), state["key_points"], state["guidelines"], state["warnings"]
+        )
+    except BaseException:
+        await detach_files(sync_client, None, list(uploaded.values()), user_id)
+        raise
+    shards = {key: {"hash": state["shard_hashes"][key], "file_id": file_id} for key, file_id in uploaded.items()}
+
+    # جایگزینی اتمیک: فقط اگر Assistant فعلی همانی باشد که بازسازی از آن شروع شد
+    swap = await async_ai_configs_collection.update_one(
+        {"_id": ai_config["_id"], "assistant_id": assistant_id},
+        {
+            "$set": {
+                "assistant_id": new_assistant_id,
+                "vector_store_id": new_vector_store_id,
+                "shards": shards,
+                "shard_layout": shard_layout(len(state["product_data"])),
+                "prompts_hash": state["prompts_hash"],
+                "content_hash": state["content_hash"]
+            },
+            "$unset": {"file_id": ""}
+        }
+    )
+    swapped = swap.matched_count > 0
+    if not swapped:
+        logger.warning(f"Assistant for user_id={user_id} was replaced concurrently, discarding assistant_id={new_assistant_id}")
+        old_file_ids, vector_store_id, assistant_id = list(uploaded.values()), new_vector_store_id, new_assistant_id
+    else:
+        logger.info(f"Swapped in new assistant_id={new_assistant_id}, vector_store_id={new_vector_store_id} with {len(shards)} shards for user_id={user_id}")
+
+    # حذف منابع قدیمی (یا منابع جدیدی که جایگزین نشدند)
+    await detach_files(sync_client, None, old_file_ids, user_id)
+
+    if vector_store_id:
+        try:
+            await asyncio.to_thread(sync_client.vector_stores.delete, vector_store_id)
+            logger.info(f"Deleted old vector_store_id={vector_store_id} for user_id={user_id}")
+        except Exception as e:
+            logger.warning(f"Failed to delete old vector_store_id={vector_store_id}: {str(e)}")
+
+    if assistant_id:
+        try:
+            await asyncio.to_thread(sync_client.beta.assistants.delete, assistant_id)
+            logger.info(f"Deleted old assistant_id={assistant_id} for user_id={user_id}")
+        except Exception as e:
+            logger.warning(f"Failed to delete old assistant_id={assistant_id}: {str(e)}")
+    return swapped
+
+
+ASSISTANT_STREAMING = os.getenv("ASSISTANT_STREAMING", "0") == "1"
+
+_local_thread_appends: Dict[tuple, asyncio.Task] = {}
+
+def _forget_local_append(key: tuple, task: asyncio.Task) -> None:
+    # فقط اگر task جدیدتری برای همین مشتری ثبت نشده باشد حذف می‌شود
+    if _local_thread_appends.get(key) is task:
+        del _local_thread_appends[key]
+
+async def _append_local_exchange(client: AsyncOpenAI, user_id: str, customer_id: str, question: str, answer: str,
+                                 previous: Optional[asyncio.Task] = None) -> None:
+    """
+    ثبت پرسش و پاسخ محلی در Thread مشتری (یا ساخت Thread با همین دو پیام)؛ خطا فقط لاگ می‌شود
+    """
+    if previous is not None:
+        await previous
+    try:
+        thread_entry = await async_conversation_threads_collection.find_one({"customer_id": ObjectId(customer_id), "user_id": ObjectId(user_id)})
+        if thread_entry:
+            await async_conversation_threads_collection.update_one(
+                {"_id": thread_entry["_id"]},
+                {"$set": {"updated_at": datetime.utcnow()}}
+            )
+            for role, content in (("user", question), ("assistant", answer)):
+                await client.beta.threads.messages.create(thread_id=thread_entry["thread_id"], role=role, content=content)
+            return
+        thread_response = await client.beta.threads.create(
+            messages=[{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+        )
+        await async_conversation_threads_collection.insert_one({
+            "customer_id": ObjectId(customer_id),
+            "user_id": ObjectId(user_id),
+            "thread_id": thread_response.id,
+            "created_at": datetime.utcnow(),
+            "updated_at": datetime.utcnow()
+        })
+    except Exception as e:
+        logger.warning(f"Failed to record local answer in thread for customer_id={customer_id}: {str(e)}")
+
+async def stream_assistant_run(client: AsyncOpenAI, thread_id: str, assistant_id: str, message_text: str,
+                               on_text: Optional[Callable[[str], Awaitable[None]]] = None) -> tuple[Any, str, Optional[float]]:
+    """
+    اجرای run به صورت streaming؛ متن از deltaها جمع می‌شود و هر پاراگراف کامل (در صورت وجود on_text) فوراً تحویل داده می‌شود
+    خروجی: (run نهایی، متن کامل، زمان رسیدن اولین توکن)
+    """
+    response_text = ""
+    delivered = 0
+    first_token_at = None
+    async with client.beta.threads.runs.stream(
+        thread_id=thread_id,
+        assistant_id=assistant_id,
+        additional_messages=[{"role": "user", "content": message_text}],
+        temperature=0.3,
+        timeout=25
+    ) as stream:
+        async for event in stream:
+            if event.event != "thread.message.delta":
+                continue
+            delta = "".join(part.text.value for part in event.data.delta.content or [] if part.type == "text" and part.text and part.text.value)
+            if not delta:
+                continue
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            response_text += delta
+            if on_text:
+                # تحویل پاراگراف‌های کامل‌شده بدون انتظار برای پایان run
+                boundary = response_text.rfind("\n\n")
+                if boundary > delivered:
+                    chunk = response_text[delivered:boundary].strip()
+                    delivered = boundary
+                    if chunk:
+                        await on_text(chunk)
+        run = await stream.get_final_run()
+
+    if on_text and run.status == "completed":
+        tail = response_text[delivered:].strip()
+        if tail:
+            await on_text(tail)
+    return run, response_text, first_token_at
+
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=4, max=10),
+    retry=retry_if_exception_type(Exception),
+    before_sleep=lambda retry_state: logger.warning(
+        f"Retrying OpenAI Assistants API request (attempt {retry_state.attempt_number}/3) after {retry_state.idle_for}s due to: {retry_state.outcome.exception()}"
+    )
+)
+async def call_openai(client: AsyncOpenAI, message_text: str, message_id: str, user_id: str, customer_id: str,
+                      stream: Optional[bool] = None, on_text: Optional[Callable[[str], Awaitable[None]]] = None) -> str:
+    """
+    فراخوانی OpenAI Assistants API برای تحلیل املاک با حفظ تاریخچه مکالمه بر اساس customer_id.
+    در حالت stream، اگر on_text داده شود پاراگراف‌های پاسخ به محض کامل شدن به آن تحویل داده می‌شوند
+    (مثلاً برای ارسال با send_ai_response) و متن کامل همچنان برگردانده می‌شود.
+    اگر بخشی از پاسخ تحویل شده باشد و run بعد از آن شکست بخورد، به جای پیام fallback رشته خالی برگردانده می‌شود
+    تا مشتری پاسخ ناقص و یک پیام متناقض را با هم دریافت نکند.
+    """
+    if stream is None:
+        stream = ASSISTANT_STREAMING
+    delivered_chunks = 0
+    if on_text is not None:
+        deliver = on_text
+
+        async def on_text(chunk: str) -> None:
+            nonlocal delivered_chunks
+            delivered_chunks += 1
+            await deliver(chunk)
+
+    def fallback_reply() -> str:
+        return "" if delivered_chunks else "Could you please clarify your request or question?"
+
+    try:
+        user_id = str(user_id).strip()
+        customer_id = str(customer_id).strip()
+        logger.debug(f"Normalized user_id={user_id}, customer_id={customer_id} for message_id={message_id}")
+        if not user_id or not customer_id:
+            logger.error(f"Missing user_id or customer_id for message_id={message_id}")
+            return "User ID and Customer ID required for property analysis"
+
+        # فیلتر کردن ورودی
+        message_text = sanitize_input(message_text)
+        if message_text == "Invalid input detected":
+            logger.error(f"Blocked dangerous input for message_id={message_id}")
+            return "Invalid input detected"
+
+        # وضعیت provisioning از کش (محصولات، پرامپت‌ها و هش محتوا)
+        with stage_timer("call_openai", "provisioning"):
+            state = await get_provisioning_state(user_id)
+        if state.get("error"):
+            return state["error"]
+        product_data = state["product_data"]
+        content_hash = state["content_hash"]
+
+        with stage_timer("call_openai", "ai_config"):
+            ai_config = await async_ai_configs_collection.find_one(
+                {"user_id": ObjectId(user_id), "auto_response_enabled": True}, projection=AI_CONFIG_PROJECTION
+            )
+        if not ai_config or not ai_config.get("api_key"):
+            logger.error(f"No valid AI config for user_id={user_id}, message_id={message_id}")
+            return "AI configuration not found"
+
+        # پرسش‌های ساده کاتالوگ بدون run روی Assistants API پاسخ داده می‌شوند؛ پرسش و پاسخ در پس‌زمینه
+        # به Thread مشتری اضافه می‌شود تا Assistant در نوبت بعد زمینه گفتگو را داشته باشد
+        with stage_timer("call_openai", "local_answer"):
+            local_response = await answer_locally(message_text, user_id, product_data, catalog_version(state))
+        if local_response:
+            logger.info(f"Answered locally for user_id={user_id}, customer_id={customer_id}, message_id={message_id}: {local_response}")
+            key = (user_id, customer_id)
+            task = asyncio.create_task(
+                _append_local_exchange(client, user_id, customer_id, message_text, local_response, _local_thread_appends.get(key))
+            )
+            _local_thread_appends[key] = task
+            task.add_done_callback(lambda done: _forget_local_append(key, done))
+            return local_response
+
+        # بررسی تغییرات در محصولات یا پرامپت‌ها؛ بازسازی Assistant در پس‌زمینه انجام می‌شود
+        assistant_id = ai_config.get("assistant_id")
+        if not assistant_id or not ai_config.get("vector_store_id"):
+            # هنوز Assistantی وجود ندارد، پس منتظر اولین ساخت می‌مانیم
+            with stage_timer("call_openai", "assistant_build"):
+                await asyncio.shield(schedule_assistant_rebuild(user_id, debounce=0))
+            ai_config = await async_ai_configs_collection.find_one(
+                {"user_id": ObjectId(user_id), "auto_response_enabled": True}, projection=AI_CONFIG_PROJECTION
+            ) or {}
+            assistant_id = ai_config.get("assistant_id")
+            if not assistant_id:
+                logger.error(f"Assistant is not ready for user_id={user_id}, message_id={message_id}")
+                return "Could you please clarify your request or question?"
+        elif ai_config.get("content_hash", "") != content_hash:
+            # تا آماده شدن Assistant جدید، پیام با Assistant قبلی پاسخ داده می‌شود
+            schedule_assistant_rebuild(user_id)
+            logger.info(f"Catalog changed for user_id={user_id}, serving with previous assistant_id={assistant_id} while rebuilding")
+        else:
+            logger.debug(f"Using existing assistant_id={assistant_id} for user_id={user_id}")
+
+        # پاسخ‌های محلی قبلی باید پیش از run جدید در Thread ثبت شده باشند
+        pending_append = _local_thread_appends.pop((user_id, customer_id), None)
+        if pending_append is not None:
+            await pending_append
+
+        # پیدا کردن یا ایجاد Thread برای مشتری
+        with stage_timer("call_openai", "thread_lookup"):
+            thread_entry = await async_conversation_threads_collection.find_one({"customer_id": ObjectId(customer_id), "user_id": ObjectId(user_id)})
+        if not thread_entry:
+            with stage_timer("call_openai", "thread_create"):
+                thread_response = await client.beta.threads.create()
+            thread_id = thread_response.id
+            await async_conversation_threads_collection.insert_one({
+                "customer_id": ObjectId(customer_id),
+                "user_id": ObjectId(user_id),
+                "thread_id": thread_id,
+                "created_at": datetime.utcnow(),
+                "updated_at": datetime.utcnow()
+            })
+            logger.info(f"Created new thread for customer_id={customer_id}, thread_id={thread_id}")
+        else:
+            thread_id = thread_entry["thread_id"]
+            logger.debug(f"Using existing thread for customer_id={customer_id}, thread_id={thread_id}")
+            # updated_at قبل از شروع run به‌روز می‌شود تا cancel_all_active_runs_for_user این Thread را فعال ببیند
+            await async_conversation_threads_collection.update_one(
+                {"_id": thread_entry["_id"]},
+                {"$set": {"updated_at": datetime.utcnow()}}
+            )
+
+        run_started = time.perf_counter()
+        if stream:
+            # حالت streaming: پیام همراه run ارسال و متن پاسخ از deltaها جمع می‌شود
+            run_response, response_text, first_token_at = await stream_assistant_run(client, thread_id, assistant_id, message_text, on_text)
+        else:
+            # افزودن پیام به Thread
+            await client.beta.threads.messages.create(
+                thread_id=thread_id,
+                role="user",
+                content=message_text
+            )
+            logger.debug(f"Message added to thread {thread_id} for user_id={user_id}")
+
+            # اجرای Thread با Assistants API
+            run_response = await client.beta.threads.runs.create_and_poll(
+                thread_id=thread_id,
+                assistant_id=assistant_id,
+                temperature=0.3,
+                timeout=25
+            )
+            response_text, first_token_at = "", None
+
+        total_ms = (time.perf_counter() - run_started) * 1000
+        stage_seconds.observe(total_ms / 1000, pipeline="call_openai", stage="run")
+        if first_token_at:
+            stage_seconds.observe(first_token_at - run_started, pipeline="call_openai", stage="first_token")
+        usage = getattr(run_response, "usage", None)
+        if usage:
+            openai_tokens_total.inc(usage.prompt_tokens, user_id=user_id, type="prompt")
+            openai_tokens_total.inc(usage.completion_tokens, user_id=user_id, type="completion")
+        ttft_ms = f"{(first_token_at - run_started) * 1000:.0f}" if first_token_at else "n/a"
+        logger.info(f"Run latency for thread_id={thread_id}, message_id={message_id}: stream={stream}, ttft_ms={ttft_ms}, total_ms={total_ms:.0f}")
+
+        if run_response is None or run_response.status != "completed":
+            logger.error(f"Run failed for thread_id={thread_id}, message_id={message_id}, status={run_response.status if run_response else None}")
+            return fallback_reply()
+
+        if not stream:
+            # گرفتن پاسخ از Thread
+            with stage_timer("call_openai", "messages_list"):
+                messages = await client.beta.threads.messages.list(thread_id=thread_id, run_id=run_response.id)
+            for msg in messages.data:
+                if msg.role == "assistant":
+                    response_text += msg.content[0].text.value + "\n"
+        response_text = response_text.strip()
+        if not response_text:
+            logger.error(f"No assistant response found for thread_id={thread_id}, message_id={message_id}")
+            return fallback_reply()
+
+        logger.info(f"Assistants API response for user_id={user_id}, customer_id={customer_id}, message_id={message_id}: {response_text}")
+
+        # به‌روزرسانی زمان Thread
+        await async_conversation_threads_collection.update_one(
+            {"customer_id": ObjectId(customer_id), "user_id": ObjectId(user_id)},
+            {"$set": {"updated_at": datetime.utcnow()}}
+        )
+
+        return response_text
+
+    except Exception as e:
+        logger.error(f"Error in call_openai for user_id={user_id}, customer_id={customer_id}, message_id={message_id}: {str(e)}")
+        return fallback_reply()
+
+
+# صف مرتب پیام‌ها به تفکیک (user_id, customer_id): روی هر Thread در هر لحظه فقط یک run اجرا می‌شود
+# و پیام‌هایی که حین اجرای run می‌رسند در یک run بعدی ادغام می‌شوند
+CUSTOMER_COALESCE_WINDOW = float(os.getenv("CUSTOMER_COALESCE_WINDOW", "0"))
+
+_customer_queues: Dict[tuple, list] = {}
+_customer_workers: Dict[tuple, asyncio.Task] = {}
+
+async def dispatch_customer_message(client: AsyncOpenAI, message_text: str, message_id: str, user_id: str, customer_id: str,
+                                    **kwargs) -> Optional[str]:
+    """
+    ارسال پیام به صف مشتری و انتظار برای پاسخ؛ مشتری‌های مختلف موازی اجرا می‌شوند.
+    اگر پیام با پیام‌های بعدی ادغام شود None برمی‌گردد و پاسخ مشترک فقط به آخرین پیام تحویل داده می‌شود.
+    فقط پیام‌های پشت‌سرهم با client و kwargs یکسان (مثلا همان stream و on_text) ادغام می‌شوند
+    """
+    key = (str(user_id).strip(), str(customer_id).strip())
+    future = asyncio.get_running_loop().create_future()
+    _customer_queues.setdefault(key, []).append((message_text, message_id, future, client, kwargs))
+
+    worker = _customer_workers.get(key)
+    if worker is None or worker.done():
+        _customer_workers[key] = asyncio.create_task(_run_customer_queue(key))
+    return await future
+
+async def _run_customer_queue(key: tuple) -> None:
+    user_id, customer_id = key
+    try:
+        while _customer_queues.get(key):
+            if CUSTOMER_COALESCE_WINDOW > 0:
+                await asyncio.sleep(CUSTOMER_COALESCE_WINDOW)
+            queue = _customer_queues.pop(key)
+            _, _, _, client, kwargs = queue[0]
+            size = 1
+            while size < len(queue) and queue[size][3] is client and queue[size][4] == kwargs:
+                size += 1
+            batch = queue[:size]
+            if size < len(queue):
+                # پیام‌های با تنظیمات متفاوت در دور بعد و با تنظیمات خودشان اجرا می‌شوند
+                _customer_queues[key] = queue[size:] + _customer_queues.get(key, [])
+            message_text = "\n".join(item[0] for item in batch)
+            message_id = batch[-1][1]
+            if len(batch) > 1:
+                logger.info(f"Coalesced {len(batch)} messages for customer_id={customer_id} into message_id={message_id}")
+
+            try:
+                response = await call_openai(client, message_text, message_id, user_id, customer_id, **kwargs)
+            except asyncio.CancelledError:
+                for item in batch:
+                    item[2].cancel()
+                raise
+            except Exception as e:
+                for item in batch:
+                    if not item[2].done():
+                        item[2].set_exception(e)
+                continue
+
+            for item in batch[:-1]:
+                if not item[2].done():
+                    item[2].set_result(None)
+            if not batch[-1][2].done():
+                batch[-1][2].set_result(response)
+    finally:
+        if _customer_workers.get(key) is asyncio.current_task():
+            del _customer_workers[key]
+
+import random  # اضافه کردن برای انتخاب رندوم
+
+# کلاینت HTTP مشترک هر پروسه (connection pool و keep-alive، و HTTP/2 در صورت نصب h2) برای Graph API و دانلود رسانه
+GRAPH_API_BASE = os.getenv("GRAPH_API_BASE", "https://graph.facebook.com/v22.0")
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1") == "1"
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    برگرداندن کلاینت HTTP مشترک؛ در اولین استفاده ساخته می‌شود
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        http2 = HTTP2_ENABLED
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("Package h2 is not installed, falling back to HTTP/1.1 for the shared HTTP client")
+                http2 = False
+        _http_client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        )
+    return _http_client
+
+async def startup_http_client() -> None:
+    """
+    هوک startup اپلیکیشن: ساخت کلاینت HTTP مشترک
+    """
+    get_http_client()
+
+async def close_http_client() -> None:
+    """
+    هوک shutdown اپلیکیشن: بستن اتصال‌های باز کلاینت HTTP مشترک
+    """
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+# کش تمپلت‌های پیام به تفکیک WABA با TTL، کش منفی و refresh پس‌زمینه
+TEMPLATE_CACHE_TTL = float(os.getenv("TEMPLATE_CACHE_TTL", "3600"))
+TEMPLATE_REFRESH_AFTER = float(os.getenv("TEMPLATE_REFRESH_AFTER", "2700"))
+TEMPLATE_NEGATIVE_TTL = float(os.getenv("TEMPLATE_NEGATIVE_TTL", "60"))
+
+_template_cache: Dict[str, Dict[str, Any]] = {}
+_template_refresh_tasks: Dict[str, asyncio.Task] = {}
+template_cache_stats = {"hits": 0, "misses": 0}
+
+async def _fetch_message_templates(waba_id: str, headers: dict) -> Dict[str, Any]:
+    """
+    خواندن تمام صفحات تمپلت‌های یک WABA و ساخت نگاشت (name, language) ← template
+    """
+    templates = {}
+    url = f"{GRAPH_API_BASE}/{waba_id}/message_templates"
+    params = {"fields": "name,language,status", "limit": 100}
+    while url:
+        response = await get_http_client().get(url, headers=headers, params=params)
+        if response.status_code != 200:
+            raise ValueError(f"Failed to fetch templates: {response.json()}")
+        body = response.json()
+        for template in body.get("data", []):
+            templates[(template["name"], template["language"])] = template
+        url = body.get("paging", {}).get("next")
+        params = None  # لینک next خودش شامل پارامترهاست
+    return templates
+
+async def _refresh_message_templates(waba_id: str, headers: dict) -> Dict[str, Any]:
+    now = time.monotonic()
+    previous = _template_cache.get(waba_id)
+    try:
+        entry = {"templates": await _fetch_message_templates(waba_id, headers), "error": None, "fetched_at": now, "expires_at": now + TEMPLATE_CACHE_TTL}
+    except Exception as e:
+        logger.error(f"Failed to fetch templates for waba_id={waba_id}: {str(e)}")
+        if previous and previous["templates"] is not None and now < previous["expires_at"]:
+            return previous  # نگه داشتن نسخه معتبر قبلی
+        entry = {"templates": None, "error": str(e), "fetched_at": now, "expires_at": now + TEMPLATE_NEGATIVE_TTL}
+    _template_cache[waba_id] = entry
+    return entry
+
+def _schedule_template_refresh(waba_id: str, headers: dict) -> asyncio.Task:
+    task = _template_refresh_tasks.get(waba_id)
+    if task is None or task.done():
+        task = asyncio.create_task(_refresh_message_templates(waba_id, headers))
+        _template_refresh_tasks[waba_id] = task
+    return task
+
+async def get_message_template(waba_id: str, headers: dict, template_name: str, language: str = "en_US") -> dict:
+    """
+    گرفتن تمپلت تاییدشده از کش؛ فقط در صورت انقضا منتظر Graph API می‌ماند و نزدیک انقضا در پس‌زمینه refresh می‌کند
+    """
+    entry = _template_cache.get(waba_id)
+    now = time.monotonic()
+    if entry is None or now >= entry["expires_at"]:
+        template_cache_stats["misses"] += 1
+        entry = await asyncio.shield(_schedule_template_refresh(waba_id, headers))
+    else:
+        template_cache_stats["hits"] += 1
+        if now - entry["fetched_at"] >= TEMPLATE_REFRESH_AFTER:
+            _schedule_template_refresh(waba_id, headers)
+
+    if entry["templates"] is None:
+        raise ValueError(f"Failed to fetch templates: {entry['error']}")
+
+    template = entry["templates"].get((template_name, language))
+    if not template or template.get("status") != "APPROVED":
+        # نتیجه منفی کش می‌شود ولی بعد از TEMPLATE_NEGATIVE_TTL در پس‌زمینه دوباره بررسی می‌شود
+        if now - entry["fetched_at"] >= TEMPLATE_NEGATIVE_TTL:
+            _schedule_template_refresh(waba_id, headers)
+    if not template:
+        logger.error(f"Template {template_name} with language {language} not found for waba_id={waba_id}")
+        raise ValueError(f"Template {template_name} with language {language} not found")
+    if template.get("status") != "APPROVED":
+        logger.error(f"Template {template_name} is not approved: status={template.get('status')}")
+        raise ValueError(f"Template {template_name} is not approved")
+    return template
+
+
+# کش رسانه آپلودشده: URL منبع (+ ETag/Last-Modified) ← media_id واتساپ به تفکیک phone_number_id
+MEDIA_CACHE_TTL = float(os.getenv("MEDIA_CACHE_TTL", str(29 * 24 * 3600)))  # واتساپ رسانه آپلودشده را ۳۰ روز نگه می‌دارد
+MEDIA_REVALIDATE_AFTER = float(os.getenv("MEDIA_REVALIDATE_AFTER", "86400"))
+MEDIA_CACHE_SIZE = int(os.getenv("MEDIA_CACHE_SIZE", "5000"))
+MEDIA_CONCURRENCY = int(os.getenv("MEDIA_CONCURRENCY", "4"))
+
+_media_cache: "OrderedDict[tuple[str, str], Dict[str, Any]]" = OrderedDict()
+_media_inflight: Dict[tuple[str, str], asyncio.Task] = {}
+media_cache_stats = {"hits": 0, "revalidated": 0, "misses": 0}
+
+def _media_file_type(file_ext: str) -> str:
+    return "document" if file_ext == ".pdf" else "image" if file_ext in [".jpg", ".jpeg", ".png"] else "video" if file_ext == ".mp4" else "audio"
+
+def _remember_media(key: tuple[str, str], entry: Dict[str, Any]) -> None:
+    _media_cache[key] = entry
+    _media_cache.move_to_end(key)
+    while len(_media_cache) > MEDIA_CACHE_SIZE:
+        _media_cache.popitem(last=False)
+
+async def get_or_upload_media(media_url: str, phone_number_id: str, access_token: str) -> Optional[str]:
+    """
+    گرفتن media_id برای URL رسانه؛ در صورت وجود در کش نه دانلود انجام می‌شود نه آپلود
+    """
+    key = (phone_number_id, media_url)
+    entry = _media_cache.get(key)
+    now = time.time()
+    if entry and now - entry["uploaded_at"] < MEDIA_CACHE_TTL and now - entry["validated_at"] < MEDIA_REVALIDATE_AFTER:
+        _media_cache.move_to_end(key)
+        media_cache_stats["hits"] += 1
+        return entry["media_id"]
+
+    # جلوگیری از دانلود/آپلود تکراری وقتی یک URL همزمان چند بار ارسال می‌شود
+    task = _media_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_download_and_upload_media(key, access_token))
+        _media_inflight[key] = task
+        task.add_done_callback(lambda _: _media_inflight.pop(key, None))
+    return await asyncio.shield(task)
+
+async def _download_and_upload_media(key: tuple[str, str], access_token: str) -> Optional[str]:
+    phone_number_id, media_url = key
+    entry = _media_cache.get(key)
+    now = time.time()
+    file_ext = os.path.splitext(media_url)[1].lower()
+
+    # اعتبارسنجی شرطی با ETag/Last-Modified؛ پاسخ 304 یعنی نیازی به دانلود و آپلود نیست
+    request_headers = {}
+    if entry and now - entry["uploaded_at"] < MEDIA_CACHE_TTL:
+        if entry.get("etag"):
+            request_headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            request_headers["If-Modified-Since"] = entry["last_modified"]
+
+    # دانلود مستقیماً به بدنه multipart آپلود stream می‌شود (بدون بافر کامل در حافظه و بدون فایل موقت)
+    async with get_http_client().stream("GET", media_url, headers=request_headers, timeout=15) as response:
+        if response.status_code == 304 and request_headers:
+            entry["validated_at"] = now
+            media_cache_stats["revalidated"] += 1
+            return entry["media_id"]
+        if response.status_code != 200:
+            logger.error(f"Failed to download media from {media_url}: {response.status_code}")
+            return None
+
+        media_cache_stats["misses"] += 1
+
+        # طول محتوا فقط وقتی معتبر است که پاسخ فشرده نشده باشد
+        content_length = response.headers.get("content-length")
+        if content_length and not response.headers.get("content-encoding"):
+            content_length = int(content_length)
+        else:
+            content_length = None
+        media_id = await upload_file_to_whatsapp(
+            response.aiter_bytes(), phone_number_id, access_token, is_pdf=(file_ext == ".pdf"),
+            filename=f"media_{uuid.uuid4().hex}{file_ext}", content_length=content_length
+        )
+    if not media_id:
+        logger.error(f"Failed to upload media from {media_url} to WhatsApp")
+        return None
+
+    _remember_media(key, {
+        "media_id": media_id,
+        "etag": response.headers.get("etag"),
+        "last_modified": response.headers.get("last-modified"),
+        "uploaded_at": now,
+        "validated_at": now
+    })
+    return media_id
+
+
+# زمان‌بند ارسال به Graph API: token bucket برای هر phone_number_id، و برای جفت (شماره، گیرنده) فقط بعد از
+# دریافت خطای 131056 برای همان جفت؛ retry با backoff تصادفی روی خطاهای محدودیت نرخ
+GRAPH_SEND_RATE = float(os.getenv("GRAPH_SEND_RATE", "80"))  # پیام در ثانیه برای هر شماره
+GRAPH_SEND_BURST = float(os.getenv("GRAPH_SEND_BURST", "80"))
+GRAPH_PAIR_RATE = float(os.getenv("GRAPH_PAIR_RATE", str(1 / 6)))  # هر ۶ ثانیه یک پیام به گیرنده محدودشده
+GRAPH_PAIR_BURST = float(os.getenv("GRAPH_PAIR_BURST", "1"))
+GRAPH_PAIR_PENALTY = float(os.getenv("GRAPH_PAIR_PENALTY", "300"))  # مدت اعمال محدودیت جفت بعد از آخرین 131056
+GRAPH_PAIR_BUCKETS = int(os.getenv("GRAPH_PAIR_BUCKETS", "50000"))
+GRAPH_PAIR_THROTTLE_CODE = 131056
+GRAPH_SEND_MAX_RETRIES = int(os.getenv("GRAPH_SEND_MAX_RETRIES", "5"))
+GRAPH_RETRY_BASE = float(os.getenv("GRAPH_RETRY_BASE", "1"))
+GRAPH_RETRY_MAX = float(os.getenv("GRAPH_RETRY_MAX", "30"))
+READ_RECEIPT_BATCH_WINDOW = float(os.getenv("READ_RECEIPT_BATCH_WINDOW", "0.25"))
+
+# 4: محدودیت اپ، 80007: محدودیت WABA، 130429: throughput شماره، 131056: محدودیت جفت فرستنده/گیرنده
+GRAPH_THROTTLE_CODES = {4, 80007, 130429, 131056}
+
+outbound_throttled_total = metrics.counter(
+    "ai_response_outbound_throttled_total", "Graph API sends rejected by rate limits", ("phone_number_id", "code")
+)
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """
+        رزرو یک توکن؛ اگر توکن آزاد نباشد مدت انتظار تا رسیدن نوبت برگردانده می‌شود
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+def _graph_throttle_code(response: httpx.Response) -> Optional[int]:
+    if response.status_code < 400:
+        return None
+    try:
+        code = response.json().get("error", {}).get("code")
+    except Exception:
+        code = None
+    if code in GRAPH_THROTTLE_CODES:
+        return code
+    return 429 if response.status_code == 429 else None
+
+class OutboundScheduler:
+    """
+    ارسال پیام‌ها به /{phone_number_id}/messages با رعایت محدودیت نرخ شماره و گیرنده؛
+    ترتیب پیام‌های یک گیرنده حفظ می‌شود چون رزرو نوبت به ترتیب فراخوانی انجام می‌شود
+    """
+
+    def __init__(self):
+        self._number_buckets: Dict[str, TokenBucket] = {}
+        self._pair_buckets: "OrderedDict[tuple[str, str], tuple[TokenBucket, float]]" = OrderedDict()
+        self._pending: Dict[str, int] = {}
+        self._read_batches: Dict[str, Dict[tuple, Dict[str, Any]]] = {}
+
+    def _reserve(self, phone_number_id: str, recipient: Optional[str]) -> float:
+        bucket = self._number_buckets.get(phone_number_id)
+        if bucket is None:
+            bucket = self._number_buckets[phone_number_id] = TokenBucket(GRAPH_SEND_RATE, GRAPH_SEND_BURST)
+        delay = bucket.reserve()
+        if recipient:
+            key = (phone_number_id, recipient)
+            pair = self._pair_buckets.get(key)
+            if pair is not None:
+                pair_bucket, penalty_until = pair
+                if time.monotonic() < penalty_until:
+                    delay = max(delay, pair_bucket.reserve())
+                else:
+                    del self._pair_buckets[key]
+        return delay
+
+    def _penalize_pair(self, phone_number_id: str, recipient: str) -> None:
+        """
+        فعال کردن (یا تمدید) محدودیت جفت بعد از 131056؛ bucket خالی شروع می‌شود تا ارسال بعدی منتظر بماند
+        """
+        key = (phone_number_id, recipient)
+        pair = self._pair_buckets.get(key)
+        pair_bucket = pair[0] if pair is not None else TokenBucket(GRAPH_PAIR_RATE, GRAPH_PAIR_BURST)
+        if pair is None:
+            pair_bucket.tokens = 0
+        self._pair_buckets[key] = (pair_bucket, time.monotonic() + GRAPH_PAIR_PENALTY)
+        self._pair_buckets.move_to_end(key)
+        while len(self._pair_buckets) > GRAPH_PAIR_BUCKETS:
+            self._pair_buckets.popitem(last=False)
+
+    async def send(self, phone_number_id: str, recipient: Optional[str], headers: dict, payload: dict) -> httpx.Response:
+        """
+        ارسال با انتظار برای نوبت token bucket و retry با backoff تصادفی روی 429 و کدهای محدودیت نرخ؛
+        پاسخ آخرین تلاش برگردانده می‌شود تا فراخواننده مثل قبل خطا را بررسی کند
+        """
+        url = f"{GRAPH_API_BASE}/{phone_number_id}/messages"
+        self._pending[phone_number_id] = self._pending.get(phone_number_id, 0) + 1
+        try:
+            attempt = 0
+            while True:
+                delay = self._reserve(phone_number_id, recipient)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                response = await get_http_client().post(url, headers=headers, json=payload)
+                code = _graph_throttle_code(response)
+                if code is None or attempt >= GRAPH_SEND_MAX_RETRIES:
+                    return response
+
+                outbound_throttled_total.inc(phone_number_id=phone_number_id, code=code)
+                if code == GRAPH_PAIR_THROTTLE_CODE and recipient:
+                    self._penalize_pair(phone_number_id, recipient)
+                backoff = min(GRAPH_RETRY_MAX, GRAPH_RETRY_BASE * 2 ** attempt)
+                backoff = backoff / 2 + random.uniform(0, backoff / 2)
+                retry_after = response.headers.get("Retry-After")
+                if retry_after and retry_after.isdigit():
+                    backoff = max(backoff, float(retry_after))
+                attempt += 1
+                logger.warning(f"Graph API throttled send from phone_number_id={phone_number_id} (code={code}), retry {attempt}/{GRAPH_SEND_MAX_RETRIES} in {backoff:.1f}s")
+                await asyncio.sleep(backoff)
+        finally:
+            self._pending[phone_number_id] -= 1
+
+    async def mark_read(self, phone_number_id: str, access_token: str, message_id: str, sender: Optional[str] = None) -> dict:
+        """
+        رسید خوانده‌شدن در دسته‌های کوتاه ارسال می‌شود؛ با داشتن sender فقط آخرین پیام هر مکالمه
+        علامت می‌خورد (واتساپ پیام‌های قبلی همان مکالمه را هم خوانده‌شده حساب می‌کند)
+        """
+        batch = self._read_batches.get(phone_number_id)
+        if batch is None:
+            batch = self._read_batches[phone_number_id] = {}
+            asyncio.create_task(self._flush_read_receipts(phone_number_id))
+        key = ("sender", sender) if sender else ("message", message_id)
+        entry = batch.get(key)
+        if entry is None:
+            entry = batch[key] = {"future": asyncio.get_running_loop().create_future()}
+        entry.update({"message_id": message_id, "access_token": access_token})
+        return await asyncio.shield(entry["future"])
+
+    async def _flush_read_receipts(self, phone_number_id: str) -> None:
+        await asyncio.sleep(READ_RECEIPT_BATCH_WINDOW)
+        batch = self._read_batches.pop(phone_number_id, {})
+
+        async def send_receipt(entry: Dict[str, Any]) -> None:
+            headers = {"Authorization": f"Bearer {entry['access_token']}", "Content-Type": "application/json"}
+            data = {"messaging_product": "whatsapp", "status": "read", "message_id": entry["message_id"]}
+            try:
+                response = await self.send(phone_number_id, None, headers, data)
+                entry["future"].set_result(response.json())
+            except Exception as e:
+                entry["future"].set_exception(e)
+
+        await asyncio.gather(*(send_receipt(entry) for entry in batch.values()))
+        if len(batch) > 1:
+            logger.debug(f"Flushed {len(batch)} read receipts for phone_number_id={phone_number_id}")
+
+    def queue_depth(self) -> Dict[str, int]:
+        """
+        تعداد ارسال‌های در انتظار نوبت، در حال ارسال یا در backoff به تفکیک phone_number_id
+        """
+        depth = dict(self._pending)
+        for phone_number_id, batch in self._read_batches.items():
+            depth[phone_number_id] = depth.get(phone_number_id, 0) + len(batch)
+        return depth
+
+outbound_scheduler = OutboundScheduler()
+
+def _outbound_metrics() -> list[str]:
+    name = "ai_response_outbound_queue_depth"
+    lines = [f"# HELP {name} Graph API sends waiting, in flight or backing off", f"# TYPE {name} gauge"]
+    for phone_number_id, depth in outbound_scheduler.queue_depth().items():
+        lines.append(f"{name}{_format_labels({'phone_number_id': phone_number_id})} {depth}")
+    return lines
+
+metrics.register_collector(_outbound_metrics)
+
+
+async def send_ai_response(user_id: str, config_name: str, customer_id: str, ai_response: str) -> None:
+    try:
+        with stage_timer("send_ai_response", "mongo_read"):
+            whatsapp_config = await async_whatsapp_configs_collection.find_one({"name": config_name, "user_id": ObjectId(user_id)})
+        if not whatsapp_config:
+            logger.error(f"No WhatsApp config found for configName: {config_name}, user_id={user_id}")
+            raise ValueError("WhatsApp config not found")
+
+
+        sender = {
+            "name": whatsapp_config["name"],
+            "phone_number": whatsapp_config["phone_number"]
+        }
+        phone_number_id = whatsapp_config["phone_number_id"]
+        access_token = whatsapp_config["access_token"]
+
+        with stage_timer("send_ai_response", "mongo_read"):
+            customer = await async_customers_collection.find_one({"_id": ObjectId(customer_id)})
+        if not customer:
+            logger.error(f"Customer not found: {customer_id}")
+            raise ValueError("Customer not found")
+
+        recipient = {
+            "type": "customer",
+            "id": customer_id,
+            "name": customer["full_name"],
+            "whatsapp_number": customer["whatsapp_number"],
+            "group_id": str(customer["group_id"]) if customer.get("group_id") else None
+        }
+        to_number = recipient["whatsapp_number"].replace("+", "") if recipient["whatsapp_number"].startswith("+") else recipient["whatsapp_number"]
+
+        now = datetime.utcnow()
+        message = {
+            "sender": sender,
+            "recipient": recipient,
+            "title": "",
+            "text": None,
+            "files": [],
+            "template_type": None,
+            "template_id": None,
+            "template_name": None,
+            "whatsapp_message_ids": [],
+            "status": "Sent",
+            "created_at": now,
+            "updated_at": now,
+            "user_id": ObjectId(user_id)
+        }
+
+        headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+
+        # تغییر جدید: بررسی برای "(Order temp)" و دو URL با انتخاب رندوم رسانه
+        if "co temp" in ai_response:
+            # استخراج URLها
+            all_urls = re.findall(r'(https?://\S+)', ai_response, re.IGNORECASE)
+            media_url_pattern = r'(https?://\S+\.(?:jpg|jpeg|png|pdf|mp4|ogg|mp3))'
+            media_urls = re.findall(media_url_pattern, ai_response, re.IGNORECASE)
+            
+            # بررسی وجود دقیقاً دو URL و حداقل یک URL رسانه‌ای
+            if len(all_urls) == 2 and len(media_urls) >= 1:
+                # انتخاب رندوم یک URL رسانه‌ای
+                media_url = random.choice(media_urls)
+                # پیدا کردن URL غیررسانه‌ای
+                non_media_url = next(url for url in all_urls if url not in media_urls)
+                
+                try:
+                    # تنظیمات تمپلت
+                    template_name = "order_temp"
+                    template_type = "approved"
+                    template_id = template_name
+                    waba_id = whatsapp_config.get("waba_id")
+
+                    # بررسی وجود و وضعیت تمپلت (از کش)
+                    with stage_timer("send_ai_response", "template"):
+                        await get_message_template(waba_id, headers, template_name, "en_US")
+
+                    # دانلود و آپلود رسانه برای هدر (یا media_id کش‌شده)
+                    file_ext = os.path.splitext(media_url)[1].lower()
+                    with stage_timer("send_ai_response", "media"):
+                        media_id = await get_or_upload_media(media_url, phone_number_id, access_token)
+                    if not media_id:
+                        raise ValueError(f"Failed to upload media from {media_url}")
+
+                    # تعیین نوع رسانه برای هدر
+                    file_type = _media_file_type(file_ext)
+                    header_component = {
+                        "type": "header",
+                        "parameters": [
+                            {
+                                "type": file_type,
+                                file_type: {"id": media_id}
+                            }
+                        ]
+                    }
+                    if file_ext == ".pdf":
+                        header_component["parameters"][0][file_type]["filename"] = f"Media{file_ext}"
+
+                    # تنظیم دکمه با URL غیررسانه‌ای
+                    button_component = {
+                        "type": "button",
+                        "sub_type": "url",
+                        "index": 0,  # فرض می‌کنیم دکمه اول در تمپلت
+                        "parameters": [
+                            {
+                                "type": "text",
+                                "text": non_media_url
+                            }
+                        ]
+                    }
+
+                    # ساخت payload برای تمپلت
+                    payload = {
+                        "messaging_product": "whatsapp",
+                        "recipient_type": "individual",
+                        "to": to_number,
+                        "type": "template",
+                        "template": {
+                            "name": template_name,
+                            "language": {"code": "en_US"},
+                            "components": [header_component, button_component]
+                        }
+                    }
+
+                    # ارسال درخواست
+                    with stage_timer("send_ai_response", "graph_send"):
+                        response = await outbound_scheduler.send(phone_number_id, to_number, headers, payload)
+                    if response.status_code == 200:
+                        message_id = response.json().get("messages", [{}])[0].get("id")
+                        if not message_id:
+                            logger.error(f"No message_id returned for template {template_name} to {to_number}")
+                            raise ValueError("No message_id returned from WhatsApp API")
+                            
+                        # ثبت پیام در دیتابیس (فقط نام تمپلت)
+                        message["text"] = ai_response
+                        message["template_type"] = template_type
+                        message["template_name"] = template_name
+                        message["template_id"] = template_id
+                        message["whatsapp_message_ids"] = [{"message_id": message_id}]
+                        with stage_timer("send_ai_response", "mongo_write"):
+                            await async_messages_collection.insert_one(message)
+                        logger.info(f"Order template {template_name} with media and URL button sent for customer_id={customer_id}, message_id={message_id}")
+                        return  # خروج زودهنگام
+                    else:
+                        logger.error(f"Failed to send template {template_name} to {to_number}: {response.json()}")
+                        raise ValueError(f"Failed to send template: {response.json()}")
+                except Exception as e:
+                    logger.error(f"Error sending template {template_name} for customer_id={customer_id}: {str(e)}")
+                    raise HTTPException(status_code=500, detail=f"Failed to send order template: {str(e)}")
+
+        # ادامه منطق اصلی برای ارسال پیام متنی، صوتی یا رسانه
+        # بررسی شرایط تبدیل به صوت
+        if (
+            ai_response and
+            not re.search(r'\d', ai_response) and
+            not re.search(r'(https?://\S+|www\.\S+)', ai_response) and
+            not re.search(r'[\+\-\*/=]', ai_response) and
+            len(ai_response) < 160
+        ):
+            logger.debug(f"Converting response to audio: {ai_response}")
+            with stage_timer("send_ai_response", "tts"):
+                media_id = await get_or_upload_tts_media(ai_response, phone_number_id, access_token)
+            if media_id:
+                payload = {
+                    "messaging_product": "whatsapp",
+                    "recipient_type": "individual",
+                    "to": to_number,
+                    "type": "audio",
+                    "audio": {"id": media_id}
+                }
+                with stage_timer("send_ai_response", "graph_send"):
+                    response = await outbound_scheduler.send(phone_number_id, to_number, headers, payload)
+                if response.status_code == 200:
+                    message_id = response.json().get("messages", [{}])[0].get("id")
+                    message["text"] = ai_response
+                    message["files"] = [f"audio_{media_id}.ogg"]
+                    message["whatsapp_message_ids"] = [{"message_id": message_id}]
+                    with stage_timer("send_ai_response", "mongo_write"):
+                        await async_messages_collection.insert_one(message)
+                    logger.info(f"AI audio response sent and saved for customer_id={customer_id}, message_id={message_id}")
+                    return
+                else:
+                    logger.error(f"Failed to send audio message: {response.json()}")
+                    raise ValueError(f"Failed to send audio message: {response.json()}")
+
+
+
+        # پردازش URLهای رسانه
+        media_urls = re.findall(r'(https?://\S+\.(?:jpg|jpeg|png|pdf|mp4|ogg|mp3))', ai_response, re.IGNORECASE)
+        saved_messages = []  # پیام‌های ارسال‌شده برای ثبت یکجا با insert_many
+        try:
+            if media_urls:
+                # دانلود و آپلود همزمان رسانه‌ها با سقف همزمانی؛ خطای هر مورد فقط همان مورد را حذف می‌کند
+                semaphore = asyncio.Semaphore(MEDIA_CONCURRENCY)
+
+                async def prepare_media(media_url: str) -> Optional[str]:
+                    async with semaphore:
+                        try:
+                            return await get_or_upload_media(media_url, phone_number_id, access_token)
+                        except Exception as e:
+                            logger.error(f"Error processing media from {media_url}: {str(e)}")
+                            return None
+
+                with stage_timer("send_ai_response", "media"):
+                    media_ids = await asyncio.gather(*(prepare_media(url) for url in media_urls))
+
+                # ارسال پیام‌ها به همان ترتیب URLها در پاسخ
+                for media_url, media_id in zip(media_urls, media_ids):
+                    if not media_id:
+                        logger.error(f"Failed to upload media from {media_url}")
+                        continue
+                    try:
+                        file_ext = os.path.splitext(media_url)[1].lower()
+                        file_type = _media_file_type(file_ext)
+                        payload = {
+                            "messaging_product": "whatsapp",
+                            "recipient_type": "individual",
+                            "to": to_number,
+                            "type": file_type,
+                            file_type: {"id": media_id}
+                        }
+                        if file_ext == ".pdf":
+                            payload[file_type]["filename"] = f"Media{file_ext}"
+                        with stage_timer("send_ai_response", "graph_send"):
+                            response = await outbound_scheduler.send(phone_number_id, to_number, headers, payload)
+                        if response.status_code == 200:
+                            message_id = response.json().get("messages", [{}])[0].get("id")
+                            saved_messages.append(dict(
+                                message,
+                                text=ai_response,
+                                files=[f"{file_type}_{media_id}{file_ext}"],
+                                title="Media",
+                                whatsapp_message_ids=[{"message_id": message_id}]
+                            ))
+                            logger.info(f"AI {file_type} response sent for customer_id={customer_id}, message_id={message_id}")
+                        else:
+                            logger.error(f"Failed to send {file_type} message: {response.json()}")
+                    except Exception as e:
+                        logger.error(f"Error sending media from {media_url}: {str(e)}")
+
+            # حذف URLها از متن اصلی برای ارسال پیام متنی
+            text_to_send = ai_response
+            if media_urls:
+                for url in media_urls:
+                    text_to_send = text_to_send.replace(url, "").strip()
+            text_to_send = text_to_send.strip()
+
+            # ارسال پیام متنی اگر متن غیرخالی وجود داشته باشد
+            if text_to_send:
+                payload = {
+                    "messaging_product": "whatsapp",
+                    "recipient_type": "individual",
+                    "to": to_number,
+                    "type": "text",
+                    "text": {"body": text_to_send}
+                }
+                with stage_timer("send_ai_response", "graph_send"):
+                    response = await outbound_scheduler.send(phone_number_id, to_number, headers, payload)
+                if response.status_code == 200:
+                    message_id = response.json().get("messages", [{}])[0].get("id")
+                    saved_messages.append(dict(message, text=text_to_send, whatsapp_message_ids=[{"message_id": message_id}]))
+                    logger.info(f"AI text response sent for customer_id={customer_id}, message_id={message_id}")
+                else:
+                    logger.error(f"Failed to send text message: {response.json()}")
+                    raise ValueError(f"Failed to send text message: {response.json()}")
+        finally:
+            # ثبت یکجای پیام‌های ارسال‌شده، حتی اگر ارسال متن شکست خورده باشد
+            if saved_messages:
+                with stage_timer("send_ai_response", "mongo_write"):
+                    await async_messages_collection.insert_many(saved_messages)
+                logger.info(f"Saved {len(saved_messages)} AI response messages for customer_id={customer_id}")
+
+    except Exception as e:
+        logger.error(f"Error sending AI response for customer_id={customer_id}: {str(e)}")
+        raise
+
+# جلوی ایندکس unique روی messageId یک LRU محلی قرار دارد تا تکراری‌های همین پروسه بدون رفت‌وبرگشت به دیتابیس رد شوند
+PROCESSED_MESSAGE_CACHE_SIZE = int(os.getenv("PROCESSED_MESSAGE_CACHE_SIZE", "50000"))
+# claimی که در این مدت processed نشود (worker کشته شده) توسط retry بعدی وبهوک قابل تصاحب است
+MESSAGE_CLAIM_LEASE = float(os.getenv("MESSAGE_CLAIM_LEASE", "300"))
+
+_seen_message_ids: "OrderedDict[str, None]" = OrderedDict()
+
+def _remember_message_id(message_id: str) -> None:
+    _seen_message_ids[message_id] = None
+    _seen_message_ids.move_to_end(message_id)
+    while len(_seen_message_ids) > PROCESSED_MESSAGE_CACHE_SIZE:
+        _seen_message_ids.popitem(last=False)
+
+async def claim_message(message_id: str, conversation_id: str, config_id: str) -> bool:
+    """
+    ثبت اتمیک پیام قبل از پردازش؛ فقط اولین worker که پیام را claim کند True می‌گیرد.
+    claimی که lease آن گذشته و هنوز processed نشده (worker حین پردازش از بین رفته) دوباره تصاحب می‌شود.
+    در صورت خطای دیتابیس پیام پردازش می‌شود تا پیامی بی‌پاسخ نماند
+    """
+    if message_id in _seen_message_ids:
+        _seen_message_ids.move_to_end(message_id)
+        logger.info(f"Skipping duplicate message {message_id} (local cache)")
+        return False
+    now = datetime.utcnow()
+    claim = {
+        "processed_at": now,
+        "claimed_until": now + timedelta(seconds=MESSAGE_CLAIM_LEASE),
+        "conversation_id": conversation_id,
+        "config_id": config_id,
+        "status": "claimed"
+    }
+    try:
+        await async_processed_messages_collection.insert_one({"messageId": message_id, **claim})
+    except DuplicateKeyError:
+        try:
+            stale = await async_processed_messages_collection.find_one_and_update(
+                {
+                    "messageId": message_id,
+                    "status": "claimed",
+                    "$or": [
+                        {"claimed_until": {"$lt": now}},
+                        {"claimed_until": {"$exists": False}, "processed_at": {"$lt": now - timedelta(seconds=MESSAGE_CLAIM_LEASE)}}
+                    ]
+                },
+                {"$set": claim},
+                projection={"_id": 1}
+            )
+        except Exception as e:
+            logger.error(f"Error taking over claim for message {message_id}: {str(e)}")
+            stale = None
+        if stale is not None:
+            logger.warning(f"Took over expired claim for message {message_id}")
+            _remember_message_id(message_id)
+            return True
+        _remember_message_id(message_id)
+        logger.info(f"Skipping duplicate message {message_id} (already claimed)")
+        return False
+    except Exception as e:
+        logger.error(f"Error claiming message {message_id}: {str(e)}")
+        return True
+    _remember_message_id(message_id)
+    return True
+
+async def release_message_claim(message_id: str) -> None:
+    """
+    آزاد کردن claim وقتی پردازش شکست خورده تا retry وبهوک دوباره پیام را پردازش کند
+    """
+    _seen_message_ids.pop(message_id, None)
+    try:
+        await async_processed_messages_collection.delete_one({"messageId": message_id, "status": "claimed"})
+    except Exception as e:
+        logger.error(f"Error releasing claim for message {message_id}: {str(e)}")
+
+async def mark_message_processed(message_id: str, conversation_id: str, config_id: str) -> None:
+    try:
+        now = datetime.utcnow()
+        await async_processed_messages_collection.update_one(
+            {"messageId": message_id},
+            {"$set": {
+                "processed_at": now,
+                "conversation_id": conversation_id,
+                "config_id": config_id,
+                "status": "processed"
+            }, "$unset": {"claimed_until": ""}},
+            upsert=True
+        )
+        _remember_message_id(message_id)
+        logger.debug(f"Marked message {message_id} as processed")
+    except Exception as e:
+        logger.error(f"Error marking message {message_id} as processed: {str(e)}")
+
+async def read_message(phone_number_id: str, access_token: str, message_id: str, sender: Optional[str] = None) -> dict:
+    """
+    علامت‌گذاری پیام به عنوان خوانده‌شده از طریق زمان‌بند ارسال؛ با sender رسیدهای پشت‌سرهم یک مکالمه ادغام می‌شوند
+    """
+    try:
+        return await outbound_scheduler.mark_read(phone_number_id, access_token, message_id, sender)
+    except Exception as e:
+        logger.error(f"Error marking message {message_id} as read: {str(e)}")
+        return {"error": str(e)} 
+
+# تنظیمات TTS؛ همین مقادیر بخشی از کلید کش صوت هستند
+TTS_MODEL = "gpt-4o-mini-tts"
+TTS_VOICE = "ash"
+TTS_SPEED = 0.9
+TTS_INSTRUCTIONS = "Speak in an energetic and positive tone."
+FFMPEG_CONCURRENCY = int(os.getenv("FFMPEG_CONCURRENCY", str(os.cpu_count() or 2)))
+
+_ffmpeg_semaphore = asyncio.Semaphore(FFMPEG_CONCURRENCY)
+
+
+class TtsAudioCache:
+    """
+    کش محتوامحور صوت OGG/opus تولیدشده با حجم محدود (LRU) و لایه دیسکی اختیاری
+    خواندن و نوشتن دیسک روی thread جدا انجام می‌شود و حجم دایرکتوری با حذف قدیمی‌ترین فایل‌ها (mtime) محدود می‌ماند
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, disk_dir: Optional[str] = None, disk_max_bytes: int = 512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._size = 0
+        self._disk_size: Optional[int] = None
+        self._disk_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        data = self._entries.get(key)
+        if data is None and self.disk_dir:
+            data = await asyncio.to_thread(self._read_disk, key)
+            if data is not None:
+                self._store(key, data)
+        if data is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    async def put(self, key: str, data: bytes) -> None:
+        self._store(key, data)
+        if self.disk_dir:
+            await asyncio.to_thread(self._write_disk, key, data)
+
+    def _store(self, key: str, data: bytes) -> None:
+        if key in self._entries:
+            self._size -= len(self._entries.pop(key))
+        self._entries[key] = data
+        self._size += len(data)
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        path = os.path.join(self.disk_dir, f"{key}.ogg")
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # mtime ترتیب LRU لایه دیسکی است
+            return data
+        except FileNotFoundError:
+            return None
+
+    def _write_disk(self, key: str, data: bytes) -> None:
+        path = os.path.join(self.disk_dir, f"{key}.ogg")
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        with self._disk_lock:
+            previous = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(temp_path, path)
+            if self._disk_size is None:
+                self._disk_size = sum(entry.stat().st_size for entry in os.scandir(self.disk_dir) if entry.name.endswith(".ogg"))
+            else:
+                self._disk_size += len(data) - previous
+            if self._disk_size > self.disk_max_bytes:
+                self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        # حذف قدیمی‌ترین فایل‌ها تا ۹۰٪ سقف تا هر نوشتن باعث اسکن دوباره دایرکتوری نشود
+        files = sorted(
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in os.scandir(self.disk_dir) if entry.name.endswith(".ogg")
+        )
+        self._disk_size = sum(size for _, size, _ in files)
+        target = self.disk_max_bytes * 0.9
+        for _, size, path in files:
+            if self._disk_size <= target:
+                break
+            try:
+                os.remove(path)
+                self._disk_size -= size
+            except FileNotFoundError:
+                pass
+        logger.debug(f"Evicted TTS disk cache down to {self._disk_size} bytes")
+
+
+tts_audio_cache = TtsAudioCache(
+    max_bytes=int(os.getenv("TTS_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+    disk_dir=os.getenv("TTS_CACHE_DIR") or None,
+    disk_max_bytes=int(os.getenv("TTS_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+)
+
+def tts_cache_key(text: str) -> str:
+    payload = json.dumps([text, TTS_MODEL, TTS_VOICE, TTS_SPEED, TTS_INSTRUCTIONS], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _cache_metrics() -> list[str]:
+    """
+    شمارنده‌های hit/miss که خود کش‌ها نگه می‌دارند؛ نرخ hit از نسبت این شمارنده‌ها محاسبه می‌شود
+    """
+    caches = {
+        "embedding": {"hit": embedding_cache.hits, "disk_hit": embedding_cache.disk_hits, "miss": embedding_cache.misses},
+        "provisioning": {"hit": provisioning_cache_stats["hits"], "revalidated": provisioning_cache_stats["revalidated"], "miss": provisioning_cache_stats["misses"], "shared": provisioning_cache_stats["shared"]},
+        "template": {"hit": template_cache_stats["hits"], "miss": template_cache_stats["misses"]},
+        "media": {"hit": media_cache_stats["hits"], "revalidated": media_cache_stats["revalidated"], "miss": media_cache_stats["misses"]},
+        "tts_audio": {"hit": tts_audio_cache.hits, "miss": tts_audio_cache.misses},
+    }
+    name = "ai_response_cache_requests_total"
+    lines = [f"# HELP {name} Cache lookups by cache and result", f"# TYPE {name} counter"]
+    for cache, results in caches.items():
+        for result, value in results.items():
+            lines.append(f"{name}{_format_labels({'cache': cache, 'result': result})} {value}")
+    return lines
+
+metrics.register_collector(_cache_metrics)
+
+async def convert_mp3_to_whatsapp_voice(mp3_data: BytesIO) -> Optional[BytesIO]:
+    try:
+        mp3_data.seek(0)
+        # ffmpeg به صورت غیرهمزمان و با سقف همزمانی اجرا می‌شود تا event loop بلاک نشود
+        async with _ffmpeg_semaphore:
+            process = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-i", "pipe:0", "-c:a", "libopus", "-b:a", "16k", "-ar", "48000", "-ac", "1", "-application", "voip", "-f", "ogg", "pipe:1",
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+            )
+            with stage_timer("tts", "ffmpeg"):
+                try:
+                    ogg_data, _ = await process.communicate(input=mp3_data.read())
+                except BaseException:
+                    # با لغو coroutine، ffmpeg نباید بدون صاحب به اجرا ادامه دهد
+                    if process.returncode is None:
+                        try:
+                            process.kill()
+                        except ProcessLookupError:
+                            pass
+                        await asyncio.shield(process.wait())
+                    raise
+        if process.returncode != 0:
+            logger.error(f"ffmpeg exited with code {process.returncode} while converting MP3 to OGG")
+            return None
+        return BytesIO(ogg_data)
+    except Exception as e:
+        logger.error(f"Error converting MP3 to OGG: {str(e)}")
+        return None
+
+async def text_to_speech(text: str, openai_client: AsyncOpenAI) -> Optional[BytesIO]:
+    key = tts_cache_key(text)
+    cached = await tts_audio_cache.get(key)
+    if cached is not None:
+        return BytesIO(cached)
+    return await _synthesize_speech(text, key, openai_client)
+
+async def _synthesize_speech(text: str, key: str, openai_client: AsyncOpenAI) -> Optional[BytesIO]:
+    try:
+        with stage_timer("tts", "synthesize"):
+            response = await openai_client.audio.speech.create(
+                model=TTS_MODEL,
+                instructions=TTS_INSTRUCTIONS,
+                speed=TTS_SPEED,
+                voice=TTS_VOICE,
+                input=text
+            )
+        audio_mp3 = BytesIO(response.content)
+        audio_mp3.seek(0)
+        audio_ogg = await convert_mp3_to_whatsapp_voice(audio_mp3)
+        if audio_ogg is not None:
+            await tts_audio_cache.put(key, audio_ogg.getvalue())
+        return audio_ogg
+    except Exception as e:
+        logger.error(f"Error in text_to_speech: {str(e)}")
+        return None
+
+async def get_or_upload_tts_media(text: str, phone_number_id: str, access_token: str) -> Optional[str]:
+    """
+    media_id پیام صوتی برای متن؛ پاسخ‌های تکراری (مثل سلام) بدون TTS، ffmpeg و آپلود دوباره ارسال می‌شوند
+    اگر TTS شکست بخورد None برمی‌گردد و اگر آپلود شکست بخورد ValueError
+    """
+    key = tts_cache_key(text)
+    media_key = (phone_number_id, f"tts:{key}")
+    entry = _media_cache.get(media_key)
+    if entry and time.time() - entry["uploaded_at"] < MEDIA_CACHE_TTL:
+        _media_cache.move_to_end(media_key)
+        media_cache_stats["hits"] += 1
+        return entry["media_id"]
+
+    cached = await tts_audio_cache.get(key)
+    if cached is not None:
+        audio_data = BytesIO(cached)
+    else:
+        ai_config = await async_ai_configs_collection.find_one({"auto_response_enabled": True}, projection=AI_CONFIG_PROJECTION)
+        async with AsyncOpenAI(api_key=ai_config["api_key"]) as client:
+            audio_data = await _synthesize_speech(text, key, client)
+    if not audio_data:
+        return None
+
+    with stage_timer("tts", "upload"):
+        media_id = await upload_file_to_whatsapp(audio_data, phone_number_id, access_token, filename=f"audio_{key[:16]}.ogg")
+    if not media_id:
+        logger.error("Failed to upload audio to WhatsApp")
+        raise ValueError("Failed to upload audio")
+    now = time.time()
+    _remember_media(media_key, {"media_id": media_id, "etag": None, "last_modified": None, "uploaded_at": now, "validated_at": now})
+    return media_id
+
+# سقف حجم رسانه در WhatsApp Cloud API به تفکیک نوع
+MEDIA_SIZE_LIMITS = {
+    "image": 5 * 1024 * 1024,
+    "video": 16 * 1024 * 1024,
+    "audio": 16 * 1024 * 1024,
+    "document": 100 * 1024 * 1024
+}
+MEDIA_MIME_TYPES = {
+    ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png", ".webp": "image/webp",
+    ".pdf": "application/pdf", ".mp4": "video/mp4", ".ogg": "audio/ogg", ".mp3": "audio/mpeg"
+}
+
+async def _iter_bytes(data: bytes) -> AsyncIterator[bytes]:
+    yield data
+
+async def _multipart_body(boundary: str, preamble: bytes, chunks: AsyncIterator[bytes], size_limit: int) -> AsyncIterator[bytes]:
+    """
+    ساخت بدنه multipart به صورت stream؛ در صورت عبور از سقف حجم، ارسال قطع می‌شود
+    """
+    yield preamble
+    total = 0
+    async for chunk in chunks:
+        total += len(chunk)
+        if total > size_limit:
+            raise ValueError(f"Media exceeds size limit of {size_limit} bytes")
+        yield chunk
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+async def upload_file_to_whatsapp(source: Union[str, bytes, BytesIO, AsyncIterator[bytes]], phone_number_id: str, access_token: str,
+                                  is_pdf: bool = False, title: str = None, filename: Optional[str] = None,
+                                  content_length: Optional[int] = None) -> Optional[str]:
+    """
+    آپلود رسانه به WhatsApp بدون فایل موقت؛ source می‌تواند مسیر فایل، bytes، BytesIO یا stream غیرهمزمان bytes باشد
+    (برای bytes/stream باید filename داده شود تا نوع فایل مشخص شود)
+    """
+    upload_url = f"{GRAPH_API_BASE}/{phone_number_id}/media"
+    file_name = source if isinstance(source, str) else filename or "media"
+    file_extension = os.path.splitext(file_name)[1].lower()
+    mime_type = MEDIA_MIME_TYPES.get(file_extension, "application/octet-stream")
+    upload_filename = f"{title}{file_extension}" if is_pdf and title else os.path.basename(file_name)
+    size_limit = MEDIA_SIZE_LIMITS[_media_file_type(file_extension)]
+
+    if isinstance(source, str):
+        source = await asyncio.to_thread(Path(source).read_bytes)
+    elif isinstance(source, BytesIO):
+        source = source.getvalue()
+    if isinstance(source, bytes):
+        content_length = len(source)
+        chunks = _iter_bytes(source)
+    else:
+        chunks = source
+    if content_length is not None and content_length > size_limit:
+        logger.error(f"Refusing to upload {file_name}: {content_length} bytes exceeds limit of {size_limit}")
+        return None
+
+    boundary = uuid.uuid4().hex
+    preamble = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"messaging_product\"\r\n\r\nwhatsapp\r\n"
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{upload_filename}\"\r\n"
+        f"Content-Type: {mime_type}\r\n\r\n"
+    ).encode()
+    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": f"multipart/form-data; boundary={boundary}"}
+    if content_length is not None:
+        headers["Content-Length"] = str(len(preamble) + content_length + len(f"\r\n--{boundary}--\r\n"))
+
+    try:
+        response = await get_http_client().post(upload_url, headers=headers, content=_multipart_body(boundary, preamble, chunks, size_limit))
+    except ValueError as e:
+        logger.error(f"Error uploading file {file_name}: {str(e)}")
+        return None
+    if response.status_code == 200:
+        return response.json().get("id")
+    logger.error(f"Error uploading file {file_name}: {response.json()}")
+    return None
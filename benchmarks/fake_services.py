@@ -0,0 +1,153 @@
+"""
+سرویس‌های جعلی OpenAI (Assistants و TTS) و Graph API واتساپ برای بنچمارک آفلاین.
+تاخیر پاسخ‌ها با FAKE_OPENAI_LATENCY_MS و FAKE_GRAPH_LATENCY_MS شبیه‌سازی می‌شود
+"""
+import asyncio
+import itertools
+import json
+import os
+import time
+
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+
+OPENAI_LATENCY = float(os.getenv("FAKE_OPENAI_LATENCY_MS", "800")) / 1000
+GRAPH_LATENCY = float(os.getenv("FAKE_GRAPH_LATENCY_MS", "80")) / 1000
+POLL_AFTER_MS = os.getenv("FAKE_POLL_AFTER_MS", "100")
+MEDIA_BYTES = int(os.getenv("FAKE_MEDIA_BYTES", str(200 * 1024)))
+ASSISTANT_REPLY = os.getenv("FAKE_ASSISTANT_REPLY", "The price is 120 AED. {base}graph/media/product.jpg")
+
+app = FastAPI()
+_ids = itertools.count(1)
+_runs: dict = {}
+
+
+def _next_id(prefix: str) -> str:
+    return f"{prefix}_{next(_ids)}"
+
+
+def _reply_text(request: Request) -> str:
+    return ASSISTANT_REPLY.format(base=str(request.base_url))
+
+
+def _run_object(run_id: str, thread_id: str, assistant_id: str, status: str) -> dict:
+    run = {
+        "id": run_id, "object": "thread.run", "created_at": int(time.time()), "thread_id": thread_id,
+        "assistant_id": assistant_id, "status": status, "instructions": "", "model": "gpt-4o-mini",
+        "tools": [], "parallel_tool_calls": True
+    }
+    if status == "completed":
+        run["usage"] = {"prompt_tokens": 1200, "completion_tokens": 40, "total_tokens": 1240}
+    return run
+
+
+def _message_object(message_id: str, thread_id: str, role: str, text: str, run_id: str = None) -> dict:
+    return {
+        "id": message_id, "object": "thread.message", "created_at": int(time.time()), "thread_id": thread_id,
+        "role": role, "status": "completed", "run_id": run_id, "attachments": [], "metadata": {},
+        "content": [{"type": "text", "text": {"value": text, "annotations": []}}]
+    }
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+########################################## OpenAI
+
+@app.post("/v1/threads")
+async def create_thread():
+    return {"id": _next_id("thread"), "object": "thread", "created_at": int(time.time()), "metadata": {}}
+
+
+@app.post("/v1/threads/{thread_id}/messages")
+async def create_message(thread_id: str, request: Request):
+    body = await request.json()
+    return _message_object(_next_id("msg"), thread_id, body.get("role", "user"), str(body.get("content", "")))
+
+
+@app.post("/v1/threads/{thread_id}/runs")
+async def create_run(thread_id: str, request: Request):
+    body = await request.json()
+    run_id = _next_id("run")
+    assistant_id = body.get("assistant_id", "")
+    if not body.get("stream"):
+        _runs[run_id] = time.monotonic()
+        return _run_object(run_id, thread_id, assistant_id, "queued")
+
+    reply = _reply_text(request)
+    message_id = _next_id("msg")
+
+    async def events():
+        yield _sse("thread.run.created", _run_object(run_id, thread_id, assistant_id, "in_progress"))
+        # زمان تا اولین توکن حدود یک‌سوم کل زمان run در نظر گرفته می‌شود
+        await asyncio.sleep(OPENAI_LATENCY / 3)
+        message = _message_object(message_id, thread_id, "assistant", "", run_id)
+        message.update({"status": "in_progress", "content": []})
+        yield _sse("thread.message.created", message)
+        words = reply.split(" ")
+        for i, word in enumerate(words):
+            value = word if i == 0 else " " + word
+            yield _sse("thread.message.delta", {
+                "id": message_id, "object": "thread.message.delta",
+                "delta": {"content": [{"index": 0, "type": "text", "text": {"value": value}}]}
+            })
+            await asyncio.sleep(OPENAI_LATENCY * 2 / 3 / len(words))
+        yield _sse("thread.run.completed", _run_object(run_id, thread_id, assistant_id, "completed"))
+        yield "event: done\ndata: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get("/v1/threads/{thread_id}/runs/{run_id}")
+async def retrieve_run(thread_id: str, run_id: str):
+    started = _runs.get(run_id, 0)
+    if time.monotonic() - started >= OPENAI_LATENCY:
+        _runs.pop(run_id, None)
+        return _run_object(run_id, thread_id, "", "completed")
+    return JSONResponse(_run_object(run_id, thread_id, "", "in_progress"), headers={"openai-poll-after-ms": POLL_AFTER_MS})
+
+
+@app.get("/v1/threads/{thread_id}/messages")
+async def list_messages(thread_id: str, request: Request):
+    run_id = request.query_params.get("run_id")
+    message = _message_object(_next_id("msg"), thread_id, "assistant", _reply_text(request), run_id)
+    return {"object": "list", "data": [message], "first_id": message["id"], "last_id": message["id"], "has_more": False}
+
+
+@app.post("/v1/audio/speech")
+async def create_speech():
+    await asyncio.sleep(OPENAI_LATENCY / 2)
+    return Response(content=b"ID3" + os.urandom(8 * 1024), media_type="audio/mpeg")
+
+
+########################################## Graph API
+
+@app.get("/graph/{waba_id}/message_templates")
+async def message_templates(waba_id: str):
+    await asyncio.sleep(GRAPH_LATENCY)
+    return {"data": [{"name": "order_temp", "language": "en_US", "status": "APPROVED"}], "paging": {}}
+
+
+@app.post("/graph/{phone_number_id}/messages")
+async def send_message(phone_number_id: str, request: Request):
+    await request.body()
+    await asyncio.sleep(GRAPH_LATENCY)
+    return {"messaging_product": "whatsapp", "messages": [{"id": _next_id("wamid")}]}
+
+
+@app.post("/graph/{phone_number_id}/media")
+async def upload_media(phone_number_id: str, request: Request):
+    await request.body()
+    await asyncio.sleep(GRAPH_LATENCY)
+    return {"id": _next_id("media")}
+
+
+@app.get("/graph/media/{name}")
+async def download_media(name: str, request: Request):
+    etag = f'"{name}-{MEDIA_BYTES}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    await asyncio.sleep(GRAPH_LATENCY)
+    media_type = "image/jpeg" if name.endswith((".jpg", ".jpeg")) else "application/octet-stream"
+    return Response(content=b"\xff\xd8" + b"\0" * MEDIA_BYTES, media_type=media_type, headers={"ETag": etag})
@@ -0,0 +1,239 @@
+"""
+بنچمارک آفلاین مسیر پاسخ (call_openai + send_ai_response) با سرویس‌های جعلی OpenAI و Graph API و mongomock.
+
+اجرا:
+    python benchmarks/run_benchmark.py --messages benchmarks/messages.jsonl --concurrency 32 --workers 2
+    python benchmarks/run_benchmark.py --save-baseline benchmarks/baseline.json
+    python benchmarks/run_benchmark.py --baseline benchmarks/baseline.json --tolerance 0.15
+
+نیازمندی‌ها علاوه بر وابستگی‌های ai_response: uvicorn و mongomock
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCH_DIR.parent
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def load_messages(path: str, repeat: int) -> list[dict]:
+    """
+    خواندن پیام‌های ورودی ضبط‌شده از JSONL؛ هر خط text (یا message/body) و customer (یا customer_id/from) دارد
+    """
+    messages = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            text = record.get("text") or record.get("message") or record.get("body") or ""
+            customer = str(record.get("customer") or record.get("customer_id") or record.get("from") or len(messages))
+            messages.append({"text": text, "customer": customer})
+    return messages * repeat
+
+
+def start_fake_services(port: int) -> None:
+    """
+    اجرای سرویس‌های جعلی در یک thread پس‌زمینه همین پروسه و صبر تا آماده شدن
+    """
+    import uvicorn
+    sys.path.insert(0, str(BENCH_DIR))
+    from fake_services import app
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", access_log=False))
+    threading.Thread(target=server.run, name="fake-services", daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+
+
+async def _seed(ar, database, customers: list[str]) -> dict:
+    from bson import ObjectId
+
+    user_id = ObjectId()
+    database.products_collection.insert_many([
+        {
+            "user_id": user_id, "name": f"Product {i}", "price": 100 + i, "isAvailable": True,
+            "description": "Benchmark product", "images": [f"https://example.com/{i}.jpg"],
+            "attributes": {"buyurl": f"https://example.com/buy/{i}"}
+        }
+        for i in range(50)
+    ])
+    database.prompts_collection.insert_many([
+        {"user_id": user_id, "type": "keyPoint", "text": "Answer briefly."},
+        {"user_id": user_id, "type": "guideline", "text": "Quote prices from the catalog."}
+    ])
+    database.whatsapp_configs_collection.insert_one({
+        "name": "benchmark", "user_id": user_id, "phone_number": "+10000000000",
+        "phone_number_id": "100000", "access_token": "benchmark", "waba_id": "200000"
+    })
+    customer_ids = {}
+    for i, customer in enumerate(customers):
+        result = database.customers_collection.insert_one({
+            "full_name": f"Customer {customer}", "whatsapp_number": f"+1555{i:07d}", "user_id": user_id
+        })
+        customer_ids[customer] = str(result.inserted_id)
+
+    # Assistant آماده و هم‌نسخه با کاتالوگ تا بنچمارک وارد مسیر بازسازی نشود
+    state = await ar.get_provisioning_state(str(user_id))
+    database.ai_configs_collection.insert_one({
+        "user_id": user_id, "auto_response_enabled": True, "api_key": "benchmark",
+        "assistant_id": "asst_benchmark", "vector_store_id": "vs_benchmark", "shards": {},
+        "content_hash": state["content_hash"], "prompts_hash": state["prompts_hash"]
+    })
+    return {"user_id": str(user_id), "customer_ids": customer_ids}
+
+
+async def _replay(worker: int, messages: list[dict], concurrency: int, stream: bool) -> dict:
+    import ai_response as ar
+    import database
+    from openai import AsyncOpenAI
+
+    seeded = await _seed(ar, database, sorted({m["customer"] for m in messages}))
+    client = AsyncOpenAI(api_key="benchmark")
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def handle(i: int, message: dict) -> None:
+        nonlocal errors
+        customer_id = seeded["customer_ids"][message["customer"]]
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                reply = await ar.dispatch_customer_message(
+                    client, message["text"], f"wamid.bench.{worker}.{i}", seeded["user_id"], customer_id, stream=stream
+                )
+                if reply:
+                    await ar.send_ai_response(seeded["user_id"], "benchmark", customer_id, reply)
+                latencies.append(time.perf_counter() - started)
+            except Exception as e:
+                errors += 1
+                logging.getLogger("benchmark").warning(f"Message {i} failed: {e}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(handle(i, message) for i, message in enumerate(messages)))
+    elapsed = time.perf_counter() - started
+    await ar.close_http_client()
+    await client.close()
+    return {
+        "worker": worker,
+        "messages": len(messages),
+        "errors": errors,
+        "elapsed": elapsed,
+        "latencies": latencies,
+        "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+
+
+def run_worker(worker: int, messages: list[dict], concurrency: int, stream: bool, env: dict) -> dict:
+    os.environ.update(env)
+    sys.path[:0] = [str(BENCH_DIR / "standins"), str(REPO_DIR)]
+    # ai_response فایل لاگ را در پوشه جاری می‌سازد؛ لاگ بنچمارک داخل مخزن نوشته نشود
+    os.chdir(tempfile.gettempdir())
+    import ai_response  # noqa: F401  پیکربندی لاگینگ ماژول قبل از کاهش سطح لاگ
+
+    logging.getLogger().setLevel(logging.WARNING)
+    return asyncio.run(_replay(worker, messages, concurrency, stream))
+
+
+def summarize(results: list[dict]) -> dict:
+    latencies = [value for result in results for value in result["latencies"]]
+    total = sum(result["messages"] for result in results)
+    elapsed = max(result["elapsed"] for result in results)
+    return {
+        "messages": total,
+        "errors": sum(result["errors"] for result in results),
+        "workers": len(results),
+        "elapsed_s": round(elapsed, 3),
+        "msgs_per_sec": round(total / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "max_ms": round(max(latencies, default=0) * 1000, 1),
+        "rss_mb_per_worker": [round(result["rss_mb"], 1) for result in results]
+    }
+
+
+def check_regression(summary: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    مقایسه با baseline؛ افزایش تاخیر p95/p99 یا کاهش throughput بیشتر از tolerance خطا حساب می‌شود
+    """
+    failures = []
+    for key in ("p95_ms", "p99_ms"):
+        if baseline.get(key) and summary[key] > baseline[key] * (1 + tolerance):
+            failures.append(f"{key} regressed: {summary[key]} > {baseline[key]} (+{tolerance:.0%})")
+    if baseline.get("msgs_per_sec") and summary["msgs_per_sec"] < baseline["msgs_per_sec"] * (1 - tolerance):
+        failures.append(f"msgs_per_sec regressed: {summary['msgs_per_sec']} < {baseline['msgs_per_sec']} (-{tolerance:.0%})")
+    if summary["errors"] > baseline.get("errors", 0):
+        failures.append(f"errors increased: {summary['errors']} > {baseline.get('errors', 0)}")
+    return failures
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Offline benchmark for call_openai/send_ai_response")
+    parser.add_argument("--messages", default=str(BENCH_DIR / "messages.jsonl"), help="JSONL file of recorded inbound messages")
+    parser.add_argument("--repeat", type=int, default=10, help="Replay the message file this many times")
+    parser.add_argument("--concurrency", type=int, default=32, help="In-flight messages per worker")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes, each with its own event loop")
+    parser.add_argument("--port", type=int, default=8765, help="Port of the fake OpenAI/Graph services")
+    parser.add_argument("--stream", action="store_true", help="Use streaming assistant runs")
+    parser.add_argument("--openai-latency-ms", type=float, default=800)
+    parser.add_argument("--graph-latency-ms", type=float, default=80)
+    parser.add_argument("--output", help="Write the summary as JSON to this file")
+    parser.add_argument("--baseline", help="Fail if results regress against this summary JSON")
+    parser.add_argument("--save-baseline", help="Write the summary as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed relative regression against the baseline")
+    args = parser.parse_args()
+
+    os.environ["FAKE_OPENAI_LATENCY_MS"] = str(args.openai_latency_ms)
+    os.environ["FAKE_GRAPH_LATENCY_MS"] = str(args.graph_latency_ms)
+    start_fake_services(args.port)
+
+    env = {
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{args.port}/v1",
+        "OPENAI_API_KEY": "benchmark",
+        "GRAPH_API_BASE": f"http://127.0.0.1:{args.port}/graph",
+        "LOCAL_ANSWERS_ENABLED": os.getenv("LOCAL_ANSWERS_ENABLED", "0"),
+        "EMBEDDING_CACHE_DIR": ""
+    }
+    messages = load_messages(args.messages, args.repeat)
+    shares = [messages[i::args.workers] for i in range(args.workers)]
+
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(args.workers) as pool:
+        results = pool.starmap(run_worker, [(i, share, args.concurrency, args.stream, env) for i, share in enumerate(shares)])
+
+    summary = summarize(results)
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        Path(args.output).write_text(json.dumps(summary, indent=2), encoding="utf-8")
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(json.dumps(summary, indent=2), encoding="utf-8")
+
+    if args.baseline:
+        failures = check_regression(summary, json.loads(Path(args.baseline).read_text(encoding="utf-8")), args.tolerance)
+        for failure in failures:
+            print(f"REGRESSION: {failure}", file=sys.stderr)
+        return 1 if failures else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,7 @@
+"""
+جایگزین ماژول auth برای بنچمارک
+"""
+
+
+def get_user_token(*args, **kwargs):
+    return "benchmark-token"
@@ -0,0 +1,16 @@
+"""
+جایگزین ماژول database برای بنچمارک: همان collectionها روی mongomock (بدون نیاز به سرور Mongo)
+"""
+import mongomock
+
+client = mongomock.MongoClient()
+db = client["ai_response_benchmark"]
+
+ai_configs_collection = db["ai_configs"]
+whatsapp_configs_collection = db["whatsapp_configs"]
+processed_messages_collection = db["processed_messages"]
+messages_collection = db["messages"]
+customers_collection = db["customers"]
+products_collection = db["products"]
+prompts_collection = db["prompts"]
+conversation_threads_collection = db["conversation_threads"]